@@ -6,6 +6,7 @@ from api_handler import generate_report_with_data, summarize_file, create_test_f
 import io
 import base64
 import os
+import multiprocessing
 from werkzeug.utils import secure_filename
 import weasyprint
 from sqlalchemy import or_
@@ -37,6 +38,16 @@ from flask_socketio import SocketIO, emit, join_room, leave_room
 # SNS機能のBlueprintをインポート
 from community import community_bp, circle_management_bp, init_socketio
 from dm import dm_bp, init_dm_socketio
+import ranking
+import realtime
+import dm_writer
+import media_store
+import image_derivatives
+import metrics
+from blocking import init_blocking
+from presence import init_presence, start_presence_heartbeat
+import wire
+from shared_store import SOCKETIO_MESSAGE_QUEUE
 
 # 循環インポートを解消するため、extensions.pyからdbをインポート
 from extensions import db
@@ -56,7 +67,9 @@ app.config['SESSION_COOKIE_SECURE'] = os.environ.get('SESSION_COOKIE_SECURE', 'f
 app.config['REMEMBER_COOKIE_SECURE'] = os.environ.get('REMEMBER_COOKIE_SECURE', 'false').lower() == 'true'
 
 # Flask-SocketIOのインスタンスを作成
-socketio = SocketIO(app)
+# SOCKETIO_MESSAGE_QUEUE (未設定なら REDIS_URL) を指定すると、どのワーカーからの emit も全ワーカーの接続に届く
+# SOCKETIO_ASYNC_MODE=eventlet / gevent で起動する場合は server.py をエントリポイントにする
+socketio = SocketIO(app, message_queue=SOCKETIO_MESSAGE_QUEUE, async_mode=os.environ.get('SOCKETIO_ASYNC_MODE'))
 
 # Simple in-memory cache (single-process)
 _SIMPLE_CACHE = {}
@@ -89,6 +102,11 @@ def generate_csrf_token():
 def inject_csrf():
     return {'csrf_token': generate_csrf_token}
 
+@app.context_processor
+def inject_realtime_codec():
+    # base.html の Socket.IO クライアントが compact 形式 (wire.py) を復元するためのキー対応表
+    return {'realtime_compact': wire.compact_enabled(), 'realtime_short_keys': wire.SHORT_KEYS}
+
 # Google credentials with refresh
 def get_google_credentials_or_redirect():
     if 'google_credentials' not in session:
@@ -137,6 +155,8 @@ if 'FLASK_ENV' in os.environ and os.environ['FLASK_ENV'] == 'development':
 # データベース設定
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///site.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# ブロッキング処理をスレッドプールで実行するため、SQLite接続を作成したスレッド以外でも使えるようにする
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {'check_same_thread': False}}
 # extensions.pyで定義されたdbオブジェクトをFlaskアプリに紐づける
 db.init_app(app)
 
@@ -153,10 +173,29 @@ from community import community_bp, circle_management_bp
 app.register_blueprint(community_bp)
 app.register_blueprint(circle_management_bp, url_prefix='/community/circles')
 app.register_blueprint(dm_bp, url_prefix='/dm')
+# アップロードファイルの配信 (/media/<ハッシュ値>)
+app.register_blueprint(media_store.media_bp)
 
+# 接続・ルーム参加の登録簿 (connect / disconnect ハンドラ) とリアルタイムイベントの送信形式
+init_presence(socketio)
+wire.init_wire(socketio)
 # SocketIOインスタンスをコミュニティBlueprintに渡す
 init_socketio(socketio)
 init_dm_socketio(socketio)
+# DBアクセスなどのブロッキング処理を退避するスレッドプール
+init_blocking(app, socketio.async_mode)
+# いいね・リアクション通知の集約
+realtime.init_realtime(socketio)
+# バックグラウンドタスクはWebサーバーのプロセスでだけ開始する。
+# 画像の縮小版を作るプロセスプール (spawn) の子プロセスは起動時にこのスクリプトを __mp_main__ として読み込み直すため、
+# そこでランキング・DM保存のワーカーを二重に起動しない
+if multiprocessing.parent_process() is None:
+    # おすすめフィードのランキングを定期的に作り直す
+    ranking.start_ranking_worker(socketio)
+    # DMメッセージのまとめ保存 (DM_WRITE_BEHIND=1 のとき)
+    dm_writer.start_dm_writer(app, socketio)
+    # Redis に登録した接続の期限の延長 (REDIS_URL 設定時)
+    start_presence_heartbeat(socketio)
 
 # ==================== Flask-Login関連 ====================
 @login_manager.user_loader
@@ -572,6 +611,14 @@ def admin_university_settings():
         
     return render_template('admin_university_settings.html', settings=settings_dict)
 
+@app.route('/admin/metrics', methods=['GET'])
+@login_required
+def admin_metrics():
+    """このワーカープロセスのメトリクス (リアルタイム通知の集約件数など) を返す"""
+    if not getattr(current_user, 'is_admin', False):
+        return jsonify({"error": "アクセス権限がありません"}), 403
+    return jsonify(metrics=metrics.snapshot())
+
 @app.route('/api/courses')
 @login_required
 def get_courses():
@@ -732,6 +779,13 @@ def register_profile():
 
     return render_template('register_profile.html', university_data=university_data)
 
+def _apply_profile_picture_variants(user_id, picture_url, variants):
+    """作成したプロフィール画像の縮小版を保存する (run_blocking 経由で呼ぶ)"""
+    User.query.filter_by(id=user_id, profile_picture_url=picture_url).update(
+        {User.profile_picture_variants: variants}, synchronize_session=False
+    )
+    db.session.commit()
+
 @app.route('/profile', methods=['GET', 'POST'])
 @login_required
 def profile():
@@ -758,20 +812,21 @@ def profile():
 
             # --- プロフィール画像のアップロード処理 ---
             if profile_picture and profile_picture.filename != '':
-                uploads_dir = os.path.join('static', 'profile_pictures')
-                os.makedirs(uploads_dir, exist_ok=True)
-                # ユーザーIDと元のファイル名を組み合わせ、一意で安全なファイル名を生成
-                filename = secure_filename(f"{current_user.id}-{profile_picture.filename}")
-                file_path = os.path.join(uploads_dir, filename)
-                profile_picture.save(file_path)
-                # データベースに保存するURLを更新
-                current_user.profile_picture_url = url_for('static', filename=f'profile_pictures/{filename}')
+                # 内容のハッシュ値で保存し (同じ画像は1つだけ保存される)、データベースに保存するURLを更新
+                current_user.profile_picture_url = media_store.save_upload(profile_picture, 'profile_pictures', current_user.id)
+                current_user.profile_picture_variants = None
                 updated_fields.append('プロフィール画像')
             
             if not updated_fields:
                 return jsonify({"success": False, "error": "更新対象がありません。"})
 
             db.session.commit()
+            if profile_picture and profile_picture.filename != '':
+                # アイコン用の縮小版はバックグラウンドで作成する
+                image_derivatives.schedule(
+                    current_user.profile_picture_url, ('avatar',), _apply_profile_picture_variants,
+                    current_user.id, current_user.profile_picture_url
+                )
             return jsonify({"success": True, "message": "、".join(updated_fields) + "を更新しました。"})
         except Exception as e:
             db.session.rollback()
@@ -1483,6 +1538,8 @@ def delete_announcement(announcement_id):
 
 if __name__ == '__main__':
     with app.app_context():
+        followers_count_added = False
+        dm_last_message_added = False
         try:
             eng = db.engine
             if eng.url.drivername.startswith('sqlite'):
@@ -1492,6 +1549,32 @@ if __name__ == '__main__':
                         con.exec_driver_sql("ALTER TABLE user ADD COLUMN is_admin BOOLEAN NOT NULL DEFAULT 0")
                     if 'timezone' not in cols:
                         con.exec_driver_sql("ALTER TABLE user ADD COLUMN timezone VARCHAR(64) NOT NULL DEFAULT 'Asia/Tokyo'")
+                    if cols and 'profile_picture_variants' not in cols:
+                        con.exec_driver_sql("ALTER TABLE user ADD COLUMN profile_picture_variants JSON")
+                    if cols and 'followers_count' not in cols:
+                        con.exec_driver_sql("ALTER TABLE user ADD COLUMN followers_count INTEGER NOT NULL DEFAULT 0")
+                        followers_count_added = True
+                    post_cols = [row[1] for row in con.exec_driver_sql("PRAGMA table_info(post)")]
+                    if post_cols and 'course_id' not in post_cols:
+                        con.exec_driver_sql("ALTER TABLE post ADD COLUMN course_id INTEGER REFERENCES course(id)")
+                    if post_cols and 'version' not in post_cols:
+                        con.exec_driver_sql("ALTER TABLE post ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+                    if post_cols and 'media_variants' not in post_cols:
+                        con.exec_driver_sql("ALTER TABLE post ADD COLUMN media_variants JSON")
+                    circle_cols = [row[1] for row in con.exec_driver_sql("PRAGMA table_info(circle)")]
+                    if circle_cols and 'background_image_variants' not in circle_cols:
+                        con.exec_driver_sql("ALTER TABLE circle ADD COLUMN background_image_variants JSON")
+                    conv_cols = [row[1] for row in con.exec_driver_sql("PRAGMA table_info(direct_message_conversation)")]
+                    if conv_cols and 'last_message_id' not in conv_cols:
+                        con.exec_driver_sql("ALTER TABLE direct_message_conversation ADD COLUMN last_message_id INTEGER REFERENCES direct_message(id)")
+                        con.exec_driver_sql("ALTER TABLE direct_message_conversation ADD COLUMN last_message_at DATETIME")
+                        dm_last_message_added = True
+                    dm_cols = [row[1] for row in con.exec_driver_sql("PRAGMA table_info(direct_message)")]
+                    if dm_cols and 'is_read' not in dm_cols:
+                        # 既存のメッセージは既読扱いにする
+                        con.exec_driver_sql("ALTER TABLE direct_message ADD COLUMN is_read BOOLEAN NOT NULL DEFAULT 1")
+                    if dm_cols and 'message_uid' not in dm_cols:
+                        con.exec_driver_sql("ALTER TABLE direct_message ADD COLUMN message_uid VARCHAR(32)")
                     idxs = [row[1] for row in con.exec_driver_sql("PRAGMA index_list('course')")]
                     if 'idx_course_univ_name_prof' not in idxs:
                         con.exec_driver_sql("CREATE INDEX idx_course_univ_name_prof ON course(university_id, course_name, professor_name)")
@@ -1499,6 +1582,139 @@ if __name__ == '__main__':
             print(f"Auto-migration warning: {_e}")
         db.create_all()
 
+        # 既存テーブルに後から追加したインデックスを作成 (新規DBはcreate_allで作成済み)
+        from models import Follow
+        try:
+            for model in (Post, Comment, Follow, DirectMessage, DirectMessageConversation):
+                for index in model.__table__.indexes:
+                    index.create(bind=db.engine, checkfirst=True)
+        except Exception as _e:
+            print(f"Index migration warning: {_e}")
+
+        # フォロー関係のJSON配列 (user.following_ids / follower_ids) を follow テーブルへ移行し、JSONカラムを廃止
+        from sqlalchemy import inspect as sa_inspect
+        try:
+            user_cols = [col['name'] for col in sa_inspect(db.engine).get_columns('user')]
+            if 'following_ids' in user_cols:
+                follow_rows = set()
+                for user_id, following_json in db.session.execute(db.text('SELECT id, following_ids FROM "user" WHERE following_ids IS NOT NULL')):
+                    following = json.loads(following_json) if isinstance(following_json, str) else (following_json or [])
+                    follow_rows.update((user_id, int(followed_id)) for followed_id in following if int(followed_id) != user_id)
+                existing_rows = {(row.follower_id, row.followed_id) for row in db.session.query(Follow.follower_id, Follow.followed_id)}
+                new_rows = follow_rows - existing_rows
+                if new_rows:
+                    db.session.execute(Follow.__table__.insert(), [
+                        {'follower_id': follower_id, 'followed_id': followed_id} for follower_id, followed_id in new_rows
+                    ])
+                    print(f"フォロー {len(new_rows)} 件を follow テーブルへ移行しました。")
+                followers_count_added = True
+                db.session.commit()
+                for column in ('following_ids', 'follower_ids'):
+                    if column in user_cols:
+                        db.session.execute(db.text(f'ALTER TABLE "user" DROP COLUMN {column}'))
+                db.session.commit()
+        except Exception as _e:
+            db.session.rollback()
+            print(f"Follow migration warning: {_e}")
+
+        # フォロワー数とフォロー中タイムラインの初回作成
+        import timeline
+        from models import TimelineEntry
+        try:
+            if followers_count_added:
+                db.session.execute(db.text(
+                    'UPDATE "user" SET followers_count = (SELECT COUNT(*) FROM follow WHERE follow.followed_id = "user".id)'
+                ))
+                db.session.commit()
+            if not db.session.query(TimelineEntry.query.exists()).scalar() and db.session.query(Post.query.exists()).scalar():
+                timeline.backfill_timelines()
+                print("フォロー中タイムラインを作成しました。")
+        except Exception as _e:
+            db.session.rollback()
+            print(f"Timeline migration warning: {_e}")
+
+        # DM会話の最新メッセージ (受信箱用) の初回設定
+        try:
+            if dm_last_message_added:
+                db.session.execute(db.text(
+                    "UPDATE direct_message_conversation SET "
+                    "last_message_id = (SELECT id FROM direct_message WHERE direct_message.conversation_id = direct_message_conversation.id "
+                    "ORDER BY timestamp DESC, id DESC LIMIT 1), "
+                    "last_message_at = (SELECT MAX(timestamp) FROM direct_message WHERE direct_message.conversation_id = direct_message_conversation.id)"
+                ))
+                db.session.commit()
+        except Exception as _e:
+            db.session.rollback()
+            print(f"DM inbox migration warning: {_e}")
+
+        # DM会話を (小さいID, 大きいID) の順に正規化し、(a,b) と (b,a) で重複した会話を統合する
+        try:
+            merged_ids = []
+            reversed_convs = DirectMessageConversation.query.filter(
+                DirectMessageConversation.user1_id > DirectMessageConversation.user2_id
+            ).all()
+            for conv in reversed_convs:
+                canonical = DirectMessageConversation.query.filter_by(
+                    user1_id=conv.user2_id, user2_id=conv.user1_id
+                ).first()
+                if canonical is None:
+                    conv.user1_id, conv.user2_id = conv.user2_id, conv.user1_id
+                    continue
+                DirectMessage.query.filter_by(conversation_id=conv.id).update(
+                    {DirectMessage.conversation_id: canonical.id}, synchronize_session=False
+                )
+                last_message = DirectMessage.query.filter_by(conversation_id=canonical.id).order_by(
+                    DirectMessage.timestamp.desc(), DirectMessage.id.desc()
+                ).first()
+                canonical.last_message_id = last_message.id if last_message else None
+                canonical.last_message_at = last_message.timestamp if last_message else None
+                merged_ids.append(conv.id)
+            if merged_ids:
+                DirectMessageConversation.query.filter(DirectMessageConversation.id.in_(merged_ids)).delete(synchronize_session=False)
+            if reversed_convs:
+                db.session.commit()
+                print(f"DM会話を正規化しました (統合: {len(merged_ids)}件)。")
+        except Exception as _e:
+            db.session.rollback()
+            print(f"DM conversation migration warning: {_e}")
+
+        # リアクション集計テーブルの初回作成
+        from models import Reaction, PostReactionCount
+        try:
+            if not db.session.query(PostReactionCount.query.exists()).scalar():
+                db.session.execute(PostReactionCount.__table__.insert().from_select(
+                    ['post_id', 'emoji', 'count'],
+                    db.select(Reaction.post_id, Reaction.emoji, db.func.count(Reaction.id))
+                    .where(Reaction.post_id.isnot(None))
+                    .group_by(Reaction.post_id, Reaction.emoji)
+                ))
+                db.session.commit()
+        except Exception as _e:
+            db.session.rollback()
+            print(f"Reaction count migration warning: {_e}")
+
+        # いいねのJSON配列 (post.likes) を post_like テーブルへ移行
+        from models import PostLike
+        try:
+            post_cols = [col['name'] for col in sa_inspect(db.engine).get_columns('post')]
+            if 'likes' in post_cols and not db.session.query(PostLike.query.exists()).scalar():
+                like_rows = set()
+                for post_id, likes_json in db.session.execute(db.text("SELECT id, likes FROM post WHERE likes IS NOT NULL")):
+                    likes = json.loads(likes_json) if isinstance(likes_json, str) else (likes_json or [])
+                    like_rows.update((post_id, int(user_id)) for user_id in likes)
+                if like_rows:
+                    db.session.execute(PostLike.__table__.insert(), [
+                        {'post_id': post_id, 'user_id': user_id} for post_id, user_id in like_rows
+                    ])
+                    db.session.execute(db.text(
+                        "UPDATE post SET likes_count = (SELECT COUNT(*) FROM post_like WHERE post_like.post_id = post.id)"
+                    ))
+                    db.session.commit()
+                    print(f"いいね {len(like_rows)} 件を post_like テーブルへ移行しました。")
+        except Exception as _e:
+            db.session.rollback()
+            print(f"Post like migration warning: {_e}")
+
         # 💡ここから新しいコードを追加💡
 
         # 1. デフォルトサークルの存在を確認し、なければ作成する
@@ -0,0 +1,68 @@
+# bench_sockets.py
+"""
+Socket.IO の同時接続数ベンチマーク
+
+ログイン済みのセッションCookieで N 本の WebSocket 接続を張り、一定時間アイドルのまま保持して
+接続に成功した数・失敗した数・接続にかかった時間を表示する。
+    pip install "python-socketio[asyncio_client]"
+    python bench_sockets.py --url http://localhost:5000 --cookie "session=..." --connections 20000 --hold 60
+
+1プロセスあたりのファイルディスクリプタ上限に注意 (ulimit -n)。数万接続の計測では
+クライアントを複数マシン・複数プロセスに分けて実行する。
+"""
+import argparse
+import asyncio
+import time
+import socketio
+
+
+async def open_connection(url, cookie, semaphore, results, hold_event):
+    client = socketio.AsyncClient(reconnection=False)
+    try:
+        # 接続処理 (ハンドシェイク) の同時実行数だけを制限し、確立後はアイドルで保持する
+        async with semaphore:
+            await client.connect(url, headers={'Cookie': cookie}, transports=['websocket'], wait_timeout=30)
+        results['connected'] += 1
+    except Exception as e:
+        results['failed'] += 1
+        results['errors'][type(e).__name__] = results['errors'].get(type(e).__name__, 0) + 1
+        return
+    await hold_event.wait()
+    if client.connected:
+        results['alive'] += 1
+    await client.disconnect()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Socket.IO idle connection benchmark')
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--cookie', required=True, help='ログイン済みのCookieヘッダー (例: "session=...")')
+    parser.add_argument('--connections', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=200, help='同時に接続処理を行う数')
+    parser.add_argument('--hold', type=float, default=30.0, help='全接続後にアイドルで保持する秒数')
+    args = parser.parse_args()
+
+    results = {'connected': 0, 'failed': 0, 'alive': 0, 'errors': {}}
+    hold_event = asyncio.Event()
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    start = time.time()
+    tasks = [
+        asyncio.ensure_future(open_connection(args.url, args.cookie, semaphore, results, hold_event))
+        for _ in range(args.connections)
+    ]
+    while results['connected'] + results['failed'] < args.connections:
+        await asyncio.sleep(0.5)
+    connect_seconds = time.time() - start
+    print(f"connected={results['connected']} failed={results['failed']} in {connect_seconds:.1f}s")
+
+    await asyncio.sleep(args.hold)
+    hold_event.set()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    print(f"alive after {args.hold:.0f}s idle: {results['alive']}/{results['connected']}")
+    if results['errors']:
+        print(f"errors: {results['errors']}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
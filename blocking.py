@@ -0,0 +1,53 @@
+# blocking.py
+"""
+非同期ワーカー (eventlet / gevent) でのブロッキング処理の退避
+
+eventlet / gevent ではイベントループ (ハブ) 上でDBアクセスなどのブロッキング処理を行うと、
+その間すべての接続が止まる (sqlite3 などのC拡張はモンキーパッチで協調的にならない)。
+run_blocking() は処理を上限つきのOSスレッドプールで実行し、呼び出し元のグリーンレットだけを待たせる。
+threading モードではその場で実行する。
+"""
+import os
+from extensions import db
+
+# ブロッキング処理を実行するOSスレッド数の上限
+BLOCKING_POOL_SIZE = int(os.environ.get('BLOCKING_POOL_SIZE', 16))
+
+_app = None
+_async_mode = 'threading'
+
+
+def init_blocking(app, async_mode):
+    """アプリと Socket.IO の async_mode を設定する (スレッドプールを使う前に呼ぶ)"""
+    global _app, _async_mode
+    _app = app
+    _async_mode = async_mode or 'threading'
+    if _async_mode == 'eventlet':
+        # eventlet.tpool はこの環境変数をプール初回使用時に読む
+        os.environ.setdefault('EVENTLET_THREADPOOL_SIZE', str(BLOCKING_POOL_SIZE))
+    elif _async_mode == 'gevent':
+        from gevent import get_hub
+        get_hub().threadpool.maxsize = BLOCKING_POOL_SIZE
+
+
+def _call_in_app_context(fn, args, kwargs):
+    with _app.app_context():
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            db.session.remove()
+
+
+def run_blocking(fn, *args, **kwargs):
+    """
+    fn を新しいアプリケーションコンテキスト (専用のDBセッション) で実行して結果を返す。
+    fn の中では current_user などのリクエスト情報は使えないため、必要な値は引数で渡す。
+    戻り値はセッションから切り離された値 (dict など) にすること
+    """
+    if _async_mode == 'eventlet':
+        from eventlet import tpool
+        return tpool.execute(_call_in_app_context, fn, args, kwargs)
+    if _async_mode == 'gevent':
+        from gevent import get_hub
+        return get_hub().threadpool.apply(_call_in_app_context, (fn, args, kwargs))
+    return _call_in_app_context(fn, args, kwargs)
@@ -1,18 +1,29 @@
 # community.py
-from flask import Blueprint, jsonify, request, redirect, url_for, render_template, current_app
+from flask import Blueprint, jsonify, request, redirect, url_for, render_template
 from flask_login import current_user
-from models import Post, Comment, User, Circle, Channel, Reaction, PrivateTL, Course
+from models import Post, Comment, User, Circle, Channel, Reaction, PrivateTL, Course, TimelineEntry, PostReactionCount, PostLike, Follow, circle_members
 from flask_login import login_required, AnonymousUserMixin
-from sqlalchemy import or_
+from sqlalchemy import or_, and_, func, delete
+from extensions import db
+from db_utils import insert_ignore, upsert_increment
 import re
 import io
 from werkzeug.utils import secure_filename
-import os
 from flask_socketio import emit, join_room, leave_room
 from datetime import datetime
-import requests
 import json
-from bs4 import BeautifulSoup
+import timeline
+import feed_cache
+import ranking
+import realtime
+import presence
+import wire
+import metrics
+from blocking import run_blocking
+from rate_limit import rate_limited, allow_socket_event
+import link_preview
+import media_store
+import image_derivatives
 
 # Blueprintの定義
 community_bp = Blueprint('community', __name__, url_prefix='/community')
@@ -20,6 +31,13 @@ community_bp = Blueprint('community', __name__, url_prefix='/community')
 # SocketIOインスタンスをグローバル変数として保持
 socketio = None
 
+# フィード1ページあたりの投稿数
+FEED_PAGE_SIZE = 20
+FEED_PAGE_SIZE_MAX = 50
+# フィードに埋め込む最新コメント数と、コメント一覧APIの1ページあたりの件数
+COMMENT_PREVIEW_SIZE = 3
+COMMENT_PAGE_SIZE = 20
+
 def init_socketio(sio_instance):
     """
     SocketIOインスタンスを初期化し、イベントハンドラを登録する
@@ -27,14 +45,7 @@ def init_socketio(sio_instance):
     global socketio
     socketio = sio_instance
 
-    @socketio.on('connect', namespace='/')
-    def handle_connect():
-        if not current_user.is_authenticated:
-            print('Anonymous client attempted to connect.')
-            return False
-            
-        print(f'Client {current_user.id} connected')
-        join_room(f'user_{current_user.id}')
+    # connect / disconnect は presence.init_presence で登録する
         
     @socketio.on('join_channel', namespace='/')
     def handle_join_channel(data):
@@ -46,15 +57,12 @@ def init_socketio(sio_instance):
         circle_id = data.get('circle_id')
         tl_id = data.get('tl_id')
 
+        room_names = []
         if channel_id:
-            room_name = f'channel_{channel_id}'
-            join_room(room_name)
-            print(f'User {current_user.id} joined room: {room_name}')
-
-        if circle_id and tl_id is not None and tl_id != '0':
-             room_name = f'circle_{circle_id}_tl_{tl_id}'
-             join_room(room_name)
-             print(f'User {current_user.id} joined private TL room: {room_name}')
+            room_names.append(f'channel_{channel_id}')
+        if circle_id and tl_id is not None and str(tl_id) != '0':
+            room_names.append(f'circle_{circle_id}_tl_{tl_id}')
+        _join_authorized_rooms(room_names)
     
     @socketio.on('join_tl_room', namespace='/')
     def handle_join_tl_room(data):
@@ -62,82 +70,397 @@ def init_socketio(sio_instance):
         if not current_user.is_authenticated: return
         room_name = data.get('room_name')
         if room_name:
-            join_room(room_name)
-            print(f'User {current_user.id} joined TL room via sidebar: {room_name}')
+            _join_authorized_rooms([room_name])
     
     # 投稿作成時のハンドラ
     @socketio.on('create_post', namespace='/')
     def handle_create_post(data):
         if not current_user.is_authenticated: return
-        emit('new_post', data, room=f'channel_{data["channel_id"]}')
+        if not allow_socket_event('create_post'): return
+        room_name = f'channel_{data.get("channel_id")}'
+        if presence.in_room(request.sid, room_name):
+            wire.emit('new_post', data, room_name)
     
     # コメント作成時のハンドラ
     @socketio.on('new_comment', namespace='/')
     def handle_new_comment(data):
         if not current_user.is_authenticated: return
-        emit('new_comment', data, room=f'channel_{data["channel_id"]}')
-
-def _serialize_post(post):
-    is_liked = current_user.is_authenticated and current_user.id in (post.likes or [])
+        if not allow_socket_event('new_comment'): return
+        room_name = f'channel_{data.get("channel_id")}'
+        if presence.in_room(request.sid, room_name):
+            wire.emit('new_comment', data, room_name)
+
+    # 集約して送るリアルタイム更新の送信内容
+    realtime.register_builder('likes_updated', _likes_payloads)
+    realtime.register_builder('reaction_updated', _reaction_payloads)
+    realtime.register_builder('comment_likes_updated', _comment_likes_payloads)
+
+# Socket.IOルーム名の形式
+CHANNEL_ROOM_PATTERN = re.compile(r'^channel_(\d+)$')
+TL_ROOM_PATTERN = re.compile(r'^circle_(\d+)_tl_(\d+)$')
+# サークルに所属していなくても参加できるチャンネル
+OPEN_CHANNEL_NAMES = ('公開チャンネル', 'フォローチャンネル')
+
+def _is_circle_member(user_id, circle_id):
+    return db.session.query(
+        db.session.query(circle_members).filter_by(user_id=user_id, circle_id=circle_id).exists()
+    ).scalar()
+
+def _authorized_rooms(user_id, room_names):
+    """room_names のうち user_id が参加してよいルーム名のリストを返す (run_blocking 経由で呼ぶ)"""
+    allowed = []
+    for room_name in room_names:
+        match = CHANNEL_ROOM_PATTERN.match(room_name)
+        if match:
+            # channel_{id} はサークルのデフォルトTL (idはサークルID) と公開チャンネルの両方で使われている
+            target_id = int(match.group(1))
+            if _is_circle_member(user_id, target_id) or Channel.query.filter(
+                Channel.id == target_id, Channel.name.in_(OPEN_CHANNEL_NAMES)
+            ).first():
+                allowed.append(room_name)
+            continue
+        match = TL_ROOM_PATTERN.match(room_name)
+        if match:
+            circle_id, tl_id = int(match.group(1)), int(match.group(2))
+            if not _is_circle_member(user_id, circle_id):
+                continue
+            if tl_id:
+                tl = PrivateTL.query.get(tl_id)
+                if not tl or tl.circle_id != circle_id or user_id not in (tl.member_ids or []):
+                    continue
+            allowed.append(room_name)
+    return allowed
+
+def _join_authorized_rooms(room_names):
+    """権限のあるルームにだけ現在の接続を参加させる"""
+    allowed = run_blocking(_authorized_rooms, current_user.id, room_names)
+    for room_name in allowed:
+        presence.join(request.sid, room_name)
+        print(f'User {current_user.id} joined room: {room_name}')
+    for room_name in set(room_names) - set(allowed):
+        print(f'User {current_user.id} was refused room: {room_name}')
+
+def _room_for_post(post):
+    """投稿の更新を配信するSocket.IOルーム名 (配信先がなければ None)"""
+    if post.circle_id:
+        tl_id = post.private_tl_id or 0
+        return f'circle_{post.circle_id}_tl_{tl_id}' if tl_id != 0 else f'channel_{post.circle_id}'
+    if post.channel_id:
+        return f'channel_{post.channel_id}'
+    return None
+
+def _likes_payloads(post_ids):
+    """likes_updated の送信内容 (最新のいいね数)"""
+    rows = db.session.query(Post.id, Post.likes_count).filter(Post.id.in_(post_ids))
+    return {row.id: {'post_id': row.id, 'likes_count': row.likes_count or 0} for row in rows}
+
+def _reaction_payloads(post_ids):
+    """reaction_updated の送信内容 (最新のリアクション集計)"""
+    existing_ids = [row.id for row in db.session.query(Post.id).filter(Post.id.in_(post_ids))]
+    reaction_counts = _load_reaction_counts(existing_ids)
+    return {post_id: {'post_id': post_id, 'reaction_counts': reaction_counts.get(post_id, {})} for post_id in existing_ids}
+
+def _comment_likes_payloads(comment_ids):
+    """comment_likes_updated の送信内容 (最新のコメントいいね数)"""
+    rows = db.session.query(Comment.id, Comment.likes).filter(Comment.id.in_(comment_ids))
+    return {row.id: {'comment_id': row.id, 'likes_count': len(row.likes or [])} for row in rows}
+
+def _load_reaction_counts(post_ids):
+    """集計テーブルから {post_id: {emoji: count}} を読み込む"""
     reaction_counts = {}
-    reactions = post.reactions.all()
-    for reaction in reactions:
-        reaction_counts[reaction.emoji] = reaction_counts.get(reaction.emoji, 0) + 1
-    
+    rows = db.session.query(PostReactionCount.post_id, PostReactionCount.emoji, PostReactionCount.count).filter(
+        PostReactionCount.post_id.in_(post_ids), PostReactionCount.count > 0
+    ).all()
+    for post_id, emoji, count in rows:
+        reaction_counts.setdefault(post_id, {})[emoji] = count
+    return reaction_counts
+
+def _load_liked_post_ids(post_ids):
+    """ログインユーザーがいいねしている投稿IDの集合を1クエリで取得する"""
+    if not current_user.is_authenticated:
+        return set()
+    rows = db.session.query(PostLike.post_id).filter(
+        PostLike.user_id == current_user.id, PostLike.post_id.in_(post_ids)
+    ).all()
+    return {row.post_id for row in rows}
+
+def _delete_post_dependents(post_id):
+    """投稿削除時に、投稿に紐づく集計・タイムライン・いいねを削除する"""
+    timeline.remove_post(post_id)
+    PostReactionCount.query.filter_by(post_id=post_id).delete(synchronize_session=False)
+    PostLike.query.filter_by(post_id=post_id).delete(synchronize_session=False)
+
+def _load_users(user_ids):
+    """表示に必要なユーザー情報 (id, username, profile_picture_url, profile_picture_variants) を一括取得する"""
+    if not user_ids:
+        return {}
+    rows = db.session.query(
+        User.id, User.username, User.profile_picture_url, User.profile_picture_variants
+    ).filter(User.id.in_(user_ids))
+    return {row.id: row for row in rows}
+
+def _load_comment_previews(post_ids):
+    """各投稿の最新 COMMENT_PREVIEW_SIZE 件のコメントを古い順で取得する (ウィンドウ関数で1クエリ)"""
+    ranked = db.session.query(
+        Comment.id.label('id'),
+        func.row_number().over(
+            partition_by=Comment.post_id,
+            order_by=(Comment.created_at.desc(), Comment.id.desc())
+        ).label('rank')
+    ).filter(Comment.post_id.in_(post_ids)).subquery()
+    return Comment.query.join(ranked, ranked.c.id == Comment.id).filter(
+        ranked.c.rank <= COMMENT_PREVIEW_SIZE
+    ).order_by(Comment.created_at.asc(), Comment.id.asc()).all()
+
+def _serialize_comments(comments, users=None, with_viewer_state=True):
+    """
+    コメントリストをシリアライズする。usersを省略した場合はまとめて取得する。
+    with_viewer_state=False の場合は is_liked を False にする (フィードキャッシュ用)
+    """
+    if users is None:
+        users = _load_users({comment.user_id for comment in comments})
     comments_list = []
-    for comment in post.comments.order_by(Comment.created_at.asc()).all():
-        is_comment_liked = current_user.is_authenticated and current_user.id in (comment.likes or [])
+    for comment in comments:
+        comment_user = users.get(comment.user_id)
+        is_comment_liked = with_viewer_state and current_user.is_authenticated and current_user.id in (comment.likes or [])
         comments_list.append({
             "id": comment.id,
-            "username": comment.user.username,
-            "user_id": comment.user.id,
+            "username": comment_user.username if comment_user else None,
+            "user_id": comment.user_id,
             "content": comment.content,
             "created_at": comment.created_at.strftime('%Y/%m/%d %H:%M'),
-            "user_profile_picture_url": comment.user.profile_picture_url,
+            "created_ts": wire.epoch_seconds(comment.created_at),
+            "user_profile_picture_url": comment_user.profile_picture_url if comment_user else None,
             "is_liked": is_comment_liked,
             "likes_count": len(comment.likes or [])
         })
-        
-    circle_name = None
-    tl_name = None
-    if post.circle:
-        circle_name = post.circle.name
-        if post.private_tl:
-            tl_name = post.private_tl.name
-        else:
-            tl_name = 'Default'
-    course_info = None
-    if post.course:
-        course_info = {
-            "id": post.course.id,
-            "course_name": post.course.course_name,
-            "professor_name": post.course.professor_name,
+    return comments_list
+
+def _serialize_post_fragments(posts):
+    """
+    投稿リストを閲覧者に依存しない形でシリアライズする (is_liked は常に False)。
+    リアクション・コメント・ユーザー・サークル・TL・授業を、投稿数に依存しない固定回数のクエリで一括ロードする。
+    """
+    if not posts:
+        return []
+    post_ids = [post.id for post in posts]
+
+    reaction_counts = _load_reaction_counts(post_ids)
+
+    # 各投稿の最新コメント (プレビュー) と総数
+    comments = _load_comment_previews(post_ids)
+    comments_by_post = {}
+    for comment in comments:
+        comments_by_post.setdefault(comment.post_id, []).append(comment)
+    comment_counts = dict(
+        db.session.query(Comment.post_id, func.count(Comment.id)).filter(Comment.post_id.in_(post_ids)).group_by(Comment.post_id).all()
+    )
+
+    # 投稿者・コメント投稿者 (表示に必要なカラムのみ)
+    users = _load_users({post.user_id for post in posts} | {comment.user_id for comment in comments})
+
+    circle_ids = {post.circle_id for post in posts if post.circle_id}
+    circles = {}
+    if circle_ids:
+        circles = {row.id: row for row in db.session.query(Circle.id, Circle.name).filter(Circle.id.in_(circle_ids))}
+
+    tl_ids = {post.private_tl_id for post in posts if post.private_tl_id}
+    private_tls = {}
+    if tl_ids:
+        private_tls = {row.id: row for row in db.session.query(PrivateTL.id, PrivateTL.name).filter(PrivateTL.id.in_(tl_ids))}
+
+    course_ids = {post.course_id for post in posts if post.course_id}
+    courses = {}
+    if course_ids:
+        courses = {
+            row.id: row for row in db.session.query(Course.id, Course.course_name, Course.professor_name).filter(Course.id.in_(course_ids))
         }
 
+    posts_list = []
+    for post in posts:
+        preview_comments = comments_by_post.get(post.id, [])
+        comments_list = _serialize_comments(preview_comments, users, with_viewer_state=False)
+        comments_count = comment_counts.get(post.id, 0)
+        comments_cursor = None
+        if comments_count > len(preview_comments):
+            comments_cursor = _encode_feed_cursor(preview_comments[0])
+
+        circle_name = None
+        tl_name = None
+        circle = circles.get(post.circle_id)
+        if circle:
+            circle_name = circle.name
+            private_tl = private_tls.get(post.private_tl_id)
+            tl_name = private_tl.name if private_tl else 'Default'
+        course_info = None
+        course = courses.get(post.course_id)
+        if course:
+            course_info = {
+                "id": course.id,
+                "course_name": course.course_name,
+                "professor_name": course.professor_name,
+            }
+
+        author = users.get(post.user_id)
+        posts_list.append({
+            "id": post.id,
+            "content": post.content,
+            "user_id": post.user_id,
+            "username": author.username if author else None,
+            "user_profile_picture": _avatar_url(author) if author else None,
+            "user_profile_picture_variants": author.profile_picture_variants if author else None,
+            "likes_count": post.likes_count,
+            "comments_count": comments_count,
+            "is_liked": False,
+            "created_at": post.created_at.strftime('%Y年%m月%d日 %H:%M'),
+            "created_ts": wire.epoch_seconds(post.created_at),
+            "media_url": post.media_url,
+            "media_type": post.media_type,
+            "media_variants": post.media_variants,
+            "reaction_counts": reaction_counts.get(post.id, {}),
+            "channel_id": post.channel_id,
+            "circle_id": post.circle_id,
+            "tl_id": post.private_tl_id or 0,
+            "link_url": post.link_url,
+            "link_title": post.link_title,
+            "link_description": post.link_description,
+            "link_thumbnail_url": post.link_thumbnail_url,
+            "comments": comments_list,
+            "comments_cursor": comments_cursor,
+            "circle_name": circle_name,
+            "tl_name": tl_name,
+            "course_info": course_info
+        })
+    return posts_list
+
+def _avatar_url(user):
+    """アイコン枠に表示するプロフィール画像 (縮小版があればそれを使う)"""
+    variants = user.profile_picture_variants or {}
+    return (variants.get('avatar') or {}).get('jpeg') or user.profile_picture_url
+
+def _build_post_payloads(posts):
+    """
+    閲覧者に依存しない投稿のシリアライズ結果を返す。
+    (投稿ID, version) ごとにキャッシュし、キャッシュにない投稿だけをまとめてシリアライズする
+    """
+    if not posts:
+        return []
+    fragments = feed_cache.get_post_fragments(posts, _serialize_post_fragments)
+    return [fragments[post.id] for post in posts]
+
+def _bump_post_version(post_id):
+    """投稿の表示内容が変わったときに version を上げ、キャッシュ済みのフラグメントを無効にする (コミットは呼び出し側)"""
+    Post.query.filter_by(id=post_id).update({Post.version: Post.version + 1}, synchronize_session=False)
+
+def _apply_viewer_state(posts_list):
+    """
+    閲覧者ごとの値 (投稿・コメントの is_liked) を設定したコピーを返す。
+    posts_list はキャッシュ上で共有されているため、元のdictは変更しない
+    """
+    if not posts_list:
+        return []
+    liked_post_ids = _load_liked_post_ids([post["id"] for post in posts_list])
+
+    comment_ids = [comment["id"] for post in posts_list for comment in post["comments"]]
+    liked_comment_ids = set()
+    if comment_ids and current_user.is_authenticated:
+        liked_comment_ids = {
+            row.id for row in db.session.query(Comment.id, Comment.likes).filter(Comment.id.in_(comment_ids))
+            if current_user.id in (row.likes or [])
+        }
+
+    result = []
+    for post in posts_list:
+        post = dict(post)
+        post["is_liked"] = post["id"] in liked_post_ids
+        post["comments"] = [
+            dict(comment, is_liked=comment["id"] in liked_comment_ids) for comment in post["comments"]
+        ]
+        result.append(post)
+    return result
+
+def _serialize_posts(posts):
+    """投稿リストをまとめてシリアライズする (閲覧者ごとの値を含む)"""
+    return _apply_viewer_state(_build_post_payloads(posts))
+
+def _cached_feed_page(scope, key, load_page):
+    """
+    フィード1ページ分を feed_cache 経由で取得し、閲覧者ごとの値を上書きして返す。
+    load_page は (投稿リスト, 次ページのカーソル) を返す関数
+    """
+    def compute():
+        posts, next_cursor = load_page()
+        return _build_post_payloads(posts), next_cursor
+
+    posts_list, next_cursor = feed_cache.get_or_compute(scope, key, compute)
+    return _apply_viewer_state(posts_list), next_cursor
+
+def _post_payload(post):
+    """ソケット配信用の投稿1件 (閲覧者に依存しない。HTTPレスポンスのフィードと同じ形式)"""
+    return _build_post_payloads([post])[0]
+
+def _cached_link_preview(content):
+    """本文の最初のURLと、そのキャッシュ済みのプレビュー (未取得なら None) を返す"""
+    link_url = link_preview.find_first_url(content)
+    return link_url, (link_preview.lookup(link_url) if link_url else None)
+
+def _link_columns(link_url, cached_preview):
+    """キャッシュ済みのプレビューがあれば、投稿作成時に設定するリンク列を返す"""
+    if cached_preview is None or cached_preview.is_failure:
+        return {}
+    fields = link_preview.preview_fields(cached_preview)
     return {
-        "id": post.id,
-        "content": post.content,
-        "user_id": post.user.id,
-        "username": post.user.username,
-        "user_profile_picture": post.user.profile_picture_url,
-        "likes_count": post.likes_count,
-        "comments_count": post.comments.count(),
-        "is_liked": is_liked,
-        "created_at": post.created_at.strftime('%Y年%m月%d日 %H:%M'),
-        "media_url": post.media_url,
-        "media_type": post.media_type,
-        "reaction_counts": reaction_counts,
-        "channel_id": post.channel_id,
-        "link_url": post.link_url,
-        "link_title": post.link_title,
-        "link_description": post.link_description,
-        "link_thumbnail_url": post.link_thumbnail_url,
-        "comments": comments_list,
-        "circle_name": circle_name,
-        "tl_name": tl_name,
-        "course_info": course_info
+        'link_url': link_url,
+        'link_title': fields['title'],
+        'link_description': fields['description'],
+        'link_thumbnail_url': fields['thumbnail_url'],
     }
 
+def _schedule_link_preview(post, link_url, cached_preview):
+    """プレビューが未取得のURLなら、取得をバックグラウンドで行う (投稿のコミット後に呼ぶ)"""
+    if link_url and cached_preview is None:
+        link_preview.schedule(post.id, link_url, _apply_link_preview)
+
+def _schedule_post_media_variants(post):
+    """添付画像の縮小版の作成を予約する (投稿のコミット後に呼ぶ)"""
+    if post.media_type == 'image' and post.media_url:
+        image_derivatives.schedule(post.media_url, ('card', 'full'), _apply_post_media_variants, post.id, post.media_url)
+
+def _apply_post_media_variants(post_id, media_url, variants):
+    """作成した縮小版を投稿に保存し、(ルーム名, post_updated の送信内容) を返す (run_blocking 経由で呼ぶ)"""
+    updated = Post.query.filter_by(id=post_id, media_url=media_url).update(
+        {Post.media_variants: variants, Post.version: Post.version + 1}, synchronize_session=False
+    )
+    db.session.commit()
+    if not updated:
+        return None
+    post = Post.query.get(post_id)
+    feed_cache.invalidate_post(post)
+    return _room_for_post(post), _post_payload(post)
+
+def _apply_circle_image_variants(circle_id, image_url, variants):
+    """作成した縮小版をサークルの背景画像に保存する (run_blocking 経由で呼ぶ)"""
+    Circle.query.filter_by(id=circle_id, background_image_url=image_url).update(
+        {Circle.background_image_variants: variants}, synchronize_session=False
+    )
+    db.session.commit()
+
+def _apply_link_preview(post_id, link_url, metadata):
+    """取得したリンクプレビューを投稿に保存し、(ルーム名, post_updated の送信内容) を返す (run_blocking 経由で呼ぶ)"""
+    updated = Post.query.filter_by(id=post_id).update({
+        Post.link_url: link_url,
+        Post.link_title: metadata['title'],
+        Post.link_description: metadata['description'],
+        Post.link_thumbnail_url: metadata['thumbnail_url'],
+        Post.version: Post.version + 1
+    }, synchronize_session=False)
+    db.session.commit()
+    if not updated:
+        return None
+    post = Post.query.get(post_id)
+    feed_cache.invalidate_post(post)
+    return _room_for_post(post), _post_payload(post)
+
 # -------------------- ここからサークル機能 --------------------
 
 circle_management_bp = Blueprint('circle_management_bp', __name__, url_prefix='/circles')
@@ -146,13 +469,7 @@ def save_image_file(file, folder_name):
     if not file:
         return None
     
-    filename = secure_filename(file.filename)
-    upload_folder = os.path.join(current_app.root_path, 'static', 'uploads', folder_name)
-    os.makedirs(upload_folder, exist_ok=True)
-    filepath = os.path.join(upload_folder, filename)
-    file.save(filepath)
-    
-    return url_for('static', filename=f'uploads/{folder_name}/{filename}')
+    return media_store.save_upload(file, folder_name, current_user.id)
 
 @circle_management_bp.route('/')
 @login_required
@@ -199,7 +516,10 @@ def create_circle():
             circle.is_public = is_public
             if image_url:
                 circle.background_image_url = image_url
+                circle.background_image_variants = None
             db.session.commit()
+            if image_url:
+                image_derivatives.schedule(image_url, ('card', 'full'), _apply_circle_image_variants, circle.id, image_url)
             return redirect(url_for('circle_management_bp.circle_list'))
         else:
             new_circle = Circle(
@@ -217,6 +537,8 @@ def create_circle():
             
             new_circle.members.append(current_user)
             db.session.commit()
+            if image_url:
+                image_derivatives.schedule(image_url, ('card', 'full'), _apply_circle_image_variants, new_circle.id, image_url)
             
             return redirect(url_for('circle_management_bp.circle_list'))
         
@@ -259,15 +581,19 @@ def leave_circle(circle_id):
     
     if circle.members.count() == 0:
         try:
+            deleted_scopes = set()
             for channel in circle.channels.all():
                 for post in channel.posts.all():
+                    deleted_scopes.update(feed_cache.scopes_for_post(post))
                     db.session.query(Comment).filter_by(post_id=post.id).delete(synchronize_session=False)
                     db.session.query(Reaction).filter_by(post_id=post.id).delete(synchronize_session=False)
+                    _delete_post_dependents(post.id)
                     db.session.delete(post)
                 db.session.delete(channel)
             
             db.session.delete(circle)
             db.session.commit()
+            feed_cache.bump(*deleted_scopes)
             
             return jsonify({"message": "サークルを脱退し、サークルと関連データが完全に削除されました", "status": "deleted"}), 200
         
@@ -329,9 +655,14 @@ def delete_private_tl(circle_id, tl_id):
         return jsonify({"error": "リーダーまたはTL作成者のみが削除できます"}), 403
 
     try:
+        rows = db.session.query(Post.id, Post.user_id).filter_by(private_tl_id=tl_id).all()
+        author_ids = {row.user_id for row in rows}
+        for row in rows:
+            _delete_post_dependents(row.id)
         Post.query.filter_by(private_tl_id=tl_id).delete(synchronize_session=False)
         db.session.delete(tl)
         db.session.commit()
+        feed_cache.bump(feed_cache.circle_scope(circle_id, tl_id), *(feed_cache.user_scope(user_id) for user_id in author_ids))
         return jsonify({"message": f"プライベートTL '{tl.name}' と関連投稿を削除しました"}), 200
     except Exception as e:
         db.session.rollback()
@@ -509,6 +840,7 @@ def get_user_tls():
             'circle_id': circle.id,
             'circle_name': circle.name,
             'circle_image_url': circle.background_image_url,
+            'circle_image_variants': circle.background_image_variants,
             'tl_id': 0,
             'tl_name': 'Default TL (全員)',
             'member_count': circle.members.count()
@@ -522,6 +854,7 @@ def get_user_tls():
                     'circle_id': circle.id,
                     'circle_name': circle.name,
                     'circle_image_url': circle.background_image_url,
+                    'circle_image_variants': circle.background_image_variants,
                     'tl_id': tl.id,
                     'tl_name': tl.name,
                     'member_count': len(tl.member_ids)
@@ -529,6 +862,170 @@ def get_user_tls():
 
     return jsonify(tls=all_tls)
 
+# --- フィードのキーセットページング ---
+def _encode_feed_cursor(item):
+    """投稿・コメントの (created_at, id) からページングカーソル文字列を作る"""
+    return f"{item.created_at.isoformat()}_{item.id}"
+
+def _decode_feed_cursor(cursor):
+    """カーソル文字列を (created_at, id) に戻す。不正な値の場合は None"""
+    if not cursor:
+        return None
+    try:
+        created_at_str, post_id_str = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(created_at_str), int(post_id_str)
+    except (ValueError, TypeError):
+        return None
+
+def _get_feed_limit(default=FEED_PAGE_SIZE):
+    limit = request.args.get('limit', type=int) or default
+    return max(1, min(limit, FEED_PAGE_SIZE_MAX))
+
+def _fetch_page(query, cursor=None, limit=FEED_PAGE_SIZE, created_col=Post.created_at, id_col=Post.id):
+    """カーソルより後ろの投稿を (created_at, id) の降順で最大 limit+1 件取得する"""
+    decoded = _decode_feed_cursor(cursor)
+    if decoded:
+        cursor_created_at, cursor_id = decoded
+        query = query.filter(or_(
+            created_col < cursor_created_at,
+            and_(created_col == cursor_created_at, id_col < cursor_id)
+        ))
+    return query.order_by(created_col.desc(), id_col.desc()).limit(limit + 1).all()
+
+def _cut_page(posts, limit):
+    """limit+1件取得した結果をページと次ページのカーソルに分ける"""
+    next_cursor = None
+    if len(posts) > limit:
+        posts = posts[:limit]
+        next_cursor = _encode_feed_cursor(posts[-1])
+    return posts, next_cursor
+
+def _paginate_posts(query, cursor=None, limit=FEED_PAGE_SIZE, created_col=Post.created_at, id_col=Post.id):
+    """
+    (created_at, id) の降順でキーセットページングする。
+    OFFSETを使わないため、何ページ目でもテーブルサイズに依存せずインデックスを辿るだけで済む。
+    戻り値は (投稿リスト, 次ページのカーソル or None)
+    """
+    return _cut_page(_fetch_page(query, cursor, limit, created_col, id_col), limit)
+
+def _paginate_following(cursor=None, limit=FEED_PAGE_SIZE):
+    """
+    フォロー中フィードを取得する。
+    マテリアライズドタイムラインと、fan-out-on-read 対象アカウントの投稿をマージする。
+    """
+    posts = _fetch_page(
+        timeline.timeline_query(current_user.id), cursor, limit,
+        created_col=TimelineEntry.created_at, id_col=TimelineEntry.post_id
+    )
+    high_fanout_ids = timeline.high_fanout_followee_ids(current_user)
+    if high_fanout_ids:
+        merged = {post.id: post for post in posts}
+        for post in _fetch_page(timeline.high_fanout_posts_query(high_fanout_ids), cursor, limit):
+            merged.setdefault(post.id, post)
+        posts = sorted(merged.values(), key=lambda post: (post.created_at, post.id), reverse=True)[:limit + 1]
+    return _cut_page(posts, limit)
+
+def _feed_query(feed_type, circle_id=None, tl_id=0):
+    """フィード種別ごとの投稿クエリを返す (権限チェックは呼び出し側で行う)"""
+    if feed_type == 'circle':
+        return Post.query.filter(
+            Post.circle_id == circle_id,
+            Post.private_tl_id == (tl_id if tl_id else None)
+        )
+    if feed_type == 'recommended':
+        return Post.query.filter_by(is_public=True)
+    return None
+
+def _decode_ranked_cursor(cursor):
+    """おすすめフィードのランキング用カーソル 'r:<世代>:<offset>' を (世代, offset) に戻す。該当しない場合は None"""
+    if not cursor or not cursor.startswith('r:'):
+        return None
+    try:
+        _, generation, offset = cursor.split(':')
+        return generation, max(0, int(offset))
+    except ValueError:
+        return None
+
+def _recommended_page(cursor=None, limit=FEED_PAGE_SIZE):
+    """
+    おすすめフィード1ページ分の (シリアライズ済み投稿リスト, 次ページのカーソル) を返す。
+    ranking が計算済みの順位リストを offset で切り出し、読み終えたら候補より古い公開投稿を時系列で返す。
+    カーソルの世代が破棄済みの場合も時系列のページへ切り替える
+    """
+    query = _feed_query('recommended')
+    decoded = _decode_ranked_cursor(cursor)
+    if cursor and not decoded:
+        # ランキングを読み終えた後の時系列ページ
+        return _cached_feed_page(
+            feed_cache.PUBLIC_SCOPE, ('recommended', cursor, limit),
+            lambda: _paginate_posts(query, cursor, limit)
+        )
+
+    generation, offset = decoded or (None, 0)
+    snapshot = ranking.get_snapshot(generation)
+    ranked_ids = snapshot['post_ids']
+    if not ranked_ids:
+        return _cached_feed_page(
+            feed_cache.PUBLIC_SCOPE, ('recommended', None, limit),
+            lambda: _paginate_posts(query, None, limit)
+        )
+    if decoded and snapshot['generation'] != generation:
+        # カーソルの世代が破棄済み。別の順位リストに同じ offset を使うと重複・抜けが出るため、
+        # 残りは候補より古い投稿の時系列ページで続ける
+        chronological_cursor = _encode_feed_cursor(snapshot['oldest'])
+        return _cached_feed_page(
+            feed_cache.PUBLIC_SCOPE, ('recommended', chronological_cursor, limit),
+            lambda: _paginate_posts(query, chronological_cursor, limit)
+        )
+
+    def load_page():
+        page_ids = ranked_ids[offset:offset + limit]
+        posts_by_id = {post.id: post for post in query.filter(Post.id.in_(page_ids))}
+        posts = [posts_by_id[post_id] for post_id in page_ids if post_id in posts_by_id]
+        if offset + limit < len(ranked_ids):
+            next_cursor = f"r:{snapshot['generation']}:{offset + limit}"
+        else:
+            next_cursor = _encode_feed_cursor(snapshot['oldest'])
+        return posts, next_cursor
+
+    return _cached_feed_page(
+        feed_cache.PUBLIC_SCOPE, ('recommended', snapshot['generation'], offset, limit), load_page
+    )
+
+def _feed_scope(feed_type, circle_id=None, tl_id=0):
+    """フィード種別ごとのキャッシュscope"""
+    if feed_type == 'circle':
+        return feed_cache.circle_scope(circle_id, tl_id)
+    return feed_cache.PUBLIC_SCOPE
+
+def _serialized_feed_page(feed_type, circle_id=None, tl_id=0, cursor=None, limit=FEED_PAGE_SIZE):
+    """
+    フィード1ページ分の (シリアライズ済み投稿リスト, 次ページのカーソル) を返す。不明なフィードの場合は None。
+    公開・サークルTLのフィードは閲覧者間で共有できるためキャッシュする (フォロー中はユーザーごとなのでしない)
+    """
+    if feed_type == 'following':
+        posts, next_cursor = _paginate_following(cursor, limit)
+        return _serialize_posts(posts), next_cursor
+    if feed_type == 'recommended':
+        return _recommended_page(cursor, limit)
+    query = _feed_query(feed_type, circle_id, tl_id)
+    if query is None:
+        return None
+    return _cached_feed_page(
+        _feed_scope(feed_type, circle_id, tl_id), (feed_type, cursor, limit),
+        lambda: _paginate_posts(query, cursor, limit)
+    )
+
+def _can_view_circle_tl(circle, tl_id):
+    """サークル/TLの閲覧権限を確認する"""
+    if not circle or current_user not in circle.members:
+        return False
+    if tl_id:
+        tl = PrivateTL.query.get(tl_id)
+        if not tl or tl.circle_id != circle.id or current_user.id not in tl.member_ids:
+            return False
+    return True
+
 @community_bp.route('/api/circles/<int:circle_id>/tls/<int:tl_id>/posts', methods=['GET'])
 @login_required
 def get_tl_posts(circle_id, tl_id):
@@ -540,30 +1037,47 @@ def get_tl_posts(circle_id, tl_id):
     if current_user not in circle.members:
         return jsonify({"error": "アクセス権限がありません"}), 403
 
-    if tl_id == 0:
-        posts = Post.query.filter(
-            Post.circle_id == circle_id, 
-            Post.private_tl_id == None
-        ).order_by(Post.created_at.desc()).limit(50).all()
-    else:
+    if tl_id != 0:
         tl = PrivateTL.query.get_or_404(tl_id)
         if current_user.id not in tl.member_ids:
              return jsonify({"error": "このTLへのアクセス権限がありません"}), 403
-             
-        posts = Post.query.filter(
-            Post.circle_id == circle_id,
-            Post.private_tl_id == tl_id
-        ).order_by(Post.created_at.desc()).limit(50).all()
 
-    posts_list = [_serialize_post(post) for post in posts]
+    posts_list, next_cursor = _serialized_feed_page(
+        'circle', circle_id, tl_id,
+        cursor=request.args.get('cursor'),
+        limit=_get_feed_limit(default=FEED_PAGE_SIZE_MAX)
+    )
     
-    return jsonify(posts=posts_list)
+    return jsonify(posts=posts_list, next_cursor=next_cursor)
+
+@community_bp.route('/api/feed/<string:feed_type>', methods=['GET'])
+@login_required
+def get_feed_page(feed_type):
+    """
+    フィードの次ページを返すAPI (無限スクロール用)
+    cursor: 前ページのnext_cursor, circle_id/tl_id: サークルTLの場合に指定
+    """
+    circle_id = request.args.get('circle_id', type=int)
+    tl_id = request.args.get('tl_id', type=int) or 0
+
+    if feed_type == 'circle':
+        if not circle_id or not _can_view_circle_tl(Circle.query.get(circle_id), tl_id):
+            return jsonify({"error": "アクセス権限がありません"}), 403
+
+    page = _serialized_feed_page(feed_type, circle_id, tl_id, cursor=request.args.get('cursor'), limit=_get_feed_limit())
+    if page is None:
+        return jsonify({"error": "不明なフィードです"}), 404
+
+    posts_list, next_cursor = page
+
+    return jsonify(posts=posts_list, next_cursor=next_cursor)
 
 @community_bp.route('/')
 @community_bp.route('/<string:feed_type>')
 @login_required
 def community_feed(feed_type='recommended'):
-    posts = []
+    posts_list = []
+    next_cursor = None
     channel_id = None
     circle_id = request.args.get('circle_id', type=int)
     current_tl_id = request.args.get('tl_id', type=int) or 0
@@ -600,40 +1114,25 @@ def community_feed(feed_type='recommended'):
                     {'id': 2, 'content': '新しいプライベートTL「企画チーム」が作成されました！', 'author_name': '幹部A', 'created_at': '2025/09/24 18:30'}
                 ]
 
-            if current_tl_id == 0:
-                posts = Post.query.filter(
-                    Post.circle_id == circle_id, 
-                    Post.private_tl_id == None
-                ).order_by(Post.created_at.desc()).all()
-            else:
-                posts = Post.query.filter(
-                    Post.circle_id == circle_id,
-                    Post.private_tl_id == current_tl_id
-                ).order_by(Post.created_at.desc()).all()
+            posts_list, next_cursor = _serialized_feed_page('circle', circle_id, current_tl_id)
             
             channel_id = circle_id 
 
         elif feed_type == 'recommended':
-            posts = Post.query.filter_by(is_public=True).order_by(Post.created_at.desc()).all()
+            posts_list, next_cursor = _serialized_feed_page('recommended')
             channel = Channel.query.filter_by(name="公開チャンネル").first()
             if channel:
                 channel_id = channel.id
         elif feed_type == 'following':
-            following_ids = current_user.following_ids or []
-            following_ids.append(current_user.id)
-            
-            posts = Post.query.filter(
-                Post.user_id.in_(following_ids)
-            ).order_by(Post.created_at.desc()).all()
+            posts_list, next_cursor = _serialized_feed_page('following')
             
             channel = Channel.query.filter_by(name="フォローチャンネル").first()
             if channel:
                 channel_id = channel.id
-        
-        posts_list = [_serialize_post(post) for post in posts]
             
         return render_template('community_feed.html', 
                                posts=posts_list, 
+                               next_cursor=next_cursor,
                                feed_type=feed_type, 
                                channel_id=channel_id,
                                circle_id=circle_id,
@@ -644,23 +1143,27 @@ def community_feed(feed_type='recommended'):
         
     except Exception as e:
         print(f"Error in community_feed: {e}")
-        return render_template('community_feed.html', posts=[], feed_type=request.args.get('type', 'recommended'), channel_id=None, circle_id=None, current_tl_id=0, circle_info=None, announcements=[])
+        return render_template('community_feed.html', posts=[], next_cursor=None, feed_type=request.args.get('type', 'recommended'), channel_id=None, circle_id=None, current_tl_id=0, circle_info=None, announcements=[])
 
 
 @community_bp.route('/user/<int:user_id>')
 @login_required
 def user_profile(user_id):
     user = User.query.get_or_404(user_id)
-    is_following = user.id in (current_user.following_ids or [])
-    posts = Post.query.filter_by(user_id=user.id).order_by(Post.created_at.desc()).all()
-    
-    posts_list = [_serialize_post(post) for post in posts]
+    is_following = db.session.query(
+        Follow.query.filter_by(follower_id=current_user.id, followed_id=user.id).exists()
+    ).scalar()
+    posts_list, _ = _cached_feed_page(
+        feed_cache.user_scope(user.id), ('profile',),
+        lambda: (Post.query.filter_by(user_id=user.id).order_by(Post.created_at.desc()).all(), None)
+    )
     
     return render_template('user_profile.html', user=user, posts=posts_list, is_following=is_following)
 
 
 @community_bp.route('/posts', methods=['POST'])
 @login_required
+@rate_limited('post')
 def create_post():
     content = request.form.get('content')
     channel_id_str = request.form.get('channel_id')
@@ -670,52 +1173,6 @@ def create_post():
     if not content and not attachment:
         return jsonify({"error": "投稿内容を入力するか、ファイルを添付してください。"}), 400
     
-    url_pattern = re.compile(r'https?://[^\s<>"]+|www\.[^\s<>"]+')
-    match = url_pattern.search(content)
-    
-    link_url = None
-    link_title = None
-    link_description = None
-    link_thumbnail_url = None
-
-    if match:
-        link_url = match.group(0)
-        try:
-            youtube_url_pattern = r"(https?://)?(www\.)?(youtube\.com|youtu\.be)/(watch\?v=|embed/|v/|shorts/)?([a-zA-Z0-9_-]{11})"
-            if re.match(youtube_url_pattern, link_url):
-                oembed_url = f'https://www.youtube.com/oembed?url={link_url}&format=json'
-                response = requests.get(oembed_url, timeout=5)
-                response.raise_for_status()
-                oembed_data = response.json()
-                
-                link_title = oembed_data.get('title')
-                link_description = oembed_data.get('author_name', 'YouTube Video')
-                link_thumbnail_url = oembed_data.get('thumbnail_url')
-            else:
-                response = requests.get(link_url, timeout=5)
-                response.raise_for_status()
-                soup = BeautifulSoup(response.text, 'html.parser')
-                
-                link_title = soup.find('meta', property='og:title')
-                if link_title: link_title = link_title.get('content')
-                else: link_title = soup.title.string if soup.title else None
-                
-                link_description = soup.find('meta', property='og:description')
-                if link_description: link_description = link_description.get('content')
-                
-                link_thumbnail_url = soup.find('meta', property='og:image')
-                if link_thumbnail_url: link_thumbnail_url = link_thumbnail_url.get('content')
-
-        except requests.exceptions.RequestException as e:
-            print(f"Error fetching link metadata: {e}")
-            link_url = None
-        except Exception as e:
-            print(f"Error processing link metadata: {e}")
-            link_url = None
-        
-        if link_url:
-            pass
-
     channel_id = None
     if channel_id_str:
         try:
@@ -734,11 +1191,7 @@ def create_post():
     media_type = None
     if attachment:
         filename = secure_filename(attachment.filename)
-        upload_folder = os.path.join(current_app.root_path, 'static', 'uploads', 'posts')
-        os.makedirs(upload_folder, exist_ok=True)
-        filepath = os.path.join(upload_folder, filename)
-        attachment.save(filepath)
-        media_url = url_for('static', filename=f'uploads/posts/{filename}')
+        media_url = media_store.save_upload(attachment, 'posts', current_user.id)
         
         mimetype = attachment.mimetype
         if mimetype and mimetype.startswith('image/'):
@@ -754,6 +1207,7 @@ def create_post():
             else:
                 media_type = 'other'
             
+    link_url, cached_preview = _cached_link_preview(content)
     new_post = Post(
         content=content,
         user_id=current_user.id,
@@ -761,43 +1215,31 @@ def create_post():
         media_url=media_url,
         media_type=media_type,
         likes_count=0,
-        link_url=link_url,
-        link_title=link_title,
-        link_description=link_description,
-        link_thumbnail_url=link_thumbnail_url,
         circle_id=None,
         private_tl_id=None,
-        course_id=int(course_id) if course_id else None
+        course_id=int(course_id) if course_id else None,
+        **_link_columns(link_url, cached_preview)
     )
     db.session.add(new_post)
+    db.session.flush()
+    # フォロワーのタイムラインへ展開 (投稿と同じトランザクション)
+    timeline.fan_out_post(new_post)
     db.session.commit()
+    feed_cache.invalidate_post(new_post)
 
-    post_data = {
-        'id': new_post.id,
-        'user_id': new_post.user.id,
-        'username': new_post.user.username,
-        'user_profile_picture': new_post.user.profile_picture_url,
-        'content': new_post.content,
-        'created_at': new_post.created_at.strftime('%Y年%m月%d日 %H:%M'),
-        'likes_count': new_post.likes_count,
-        'comments_count': new_post.comments.count(),
-        'is_liked': current_user.id in (new_post.likes or []),
-        'media_url': new_post.media_url,
-        'media_type': new_post.media_type,
-        'channel_id': new_post.channel_id,
-        'link_url': new_post.link_url,
-        'link_title': new_post.link_title,
-        'link_description': new_post.link_description,
-        'link_thumbnail_url': new_post.link_thumbnail_url
-    }
-    
-    print(f"DEBUG: Emitting 'new_post' to room channel_{channel_id} with data: {post_data}")
-    socketio.emit('new_post', post_data, room=f'channel_{channel_id}', namespace='/')
+    room_name = f'channel_{channel_id}'
+    if presence.room_has_listeners(room_name):
+        post_data = _post_payload(new_post)
+        print(f"DEBUG: Emitting 'new_post' to room {room_name} with data: {post_data}")
+        wire.emit('new_post', post_data, room_name)
+    _schedule_link_preview(new_post, link_url, cached_preview)
+    _schedule_post_media_variants(new_post)
 
     return jsonify({"message": "投稿が成功しました"}), 201
 
 @community_bp.route('/circles/<int:circle_id>/posts', methods=['POST'])
 @login_required
+@rate_limited('post')
 def create_circle_post(circle_id):
     circle = Circle.query.get_or_404(circle_id)
     
@@ -818,61 +1260,11 @@ def create_circle_post(circle_id):
         if not private_tl or current_user.id not in private_tl.member_ids:
             return jsonify({"error": "このTLに投稿する権限がありません"}), 403
 
-    url_pattern = re.compile(r'https?://[^\s<>"]+|www\.[^\s<>"]+')
-    match = url_pattern.search(content)
-    
-    link_url = None
-    link_title = None
-    link_description = None
-    link_thumbnail_url = None
-
-    if match:
-        link_url = match.group(0)
-        try:
-            youtube_url_pattern = r"(https?://)?(www\.)?(youtube\.com|youtu\.be)/(watch\?v=|embed/|v/|shorts/)?([a-zA-Z0-9_-]{11})"
-            if re.match(youtube_url_pattern, link_url):
-                oembed_url = f'https://www.youtube.com/oembed?url={link_url}&format=json'
-                response = requests.get(oembed_url, timeout=5)
-                response.raise_for_status()
-                oembed_data = response.json()
-                
-                link_title = oembed_data.get('title')
-                link_description = oembed_data.get('author_name', 'YouTube Video')
-                link_thumbnail_url = oembed_data.get('thumbnail_url')
-            else:
-                response = requests.get(link_url, timeout=5)
-                response.raise_for_status()
-                soup = BeautifulSoup(response.text, 'html.parser')
-                
-                link_title = soup.find('meta', property='og:title')
-                if link_title: link_title = link_title.get('content')
-                else: link_title = soup.title.string if soup.title else None
-                
-                link_description = soup.find('meta', property='og:description')
-                if link_description: link_description = link_description.get('content')
-                
-                link_thumbnail_url = soup.find('meta', property='og:image')
-                if link_thumbnail_url: link_thumbnail_url = link_thumbnail_url.get('content')
-
-        except requests.exceptions.RequestException as e:
-            print(f"Error fetching link metadata: {e}")
-            link_url = None
-        except Exception as e:
-            print(f"Error processing link metadata: {e}")
-            link_url = None
-        
-        if link_url:
-            pass
-
     media_url = None
     media_type = None
     if attachment:
         filename = secure_filename(attachment.filename)
-        upload_folder = os.path.join(current_app.root_path, 'static', 'uploads', 'posts')
-        os.makedirs(upload_folder, exist_ok=True)
-        filepath = os.path.join(upload_folder, filename)
-        attachment.save(filepath)
-        media_url = url_for('static', filename=f'uploads/posts/{filename}')
+        media_url = media_store.save_upload(attachment, 'posts', current_user.id)
         
         mimetype = attachment.mimetype
         if mimetype and mimetype.startswith('image/'):
@@ -888,6 +1280,7 @@ def create_circle_post(circle_id):
             else:
                 media_type = 'other'
 
+    link_url, cached_preview = _cached_link_preview(content)
     new_post = Post(
         content=content,
         user_id=current_user.id,
@@ -897,22 +1290,23 @@ def create_circle_post(circle_id):
         media_url=media_url,
         media_type=media_type,
         likes_count=0,
-        link_url=link_url,
-        link_title=link_title,
-        link_description=link_description,
-        link_thumbnail_url=link_thumbnail_url,
         is_public=False,
-        course_id=int(course_id) if course_id else None
+        course_id=int(course_id) if course_id else None,
+        **_link_columns(link_url, cached_preview)
     )
     db.session.add(new_post)
     db.session.commit()
+    feed_cache.invalidate_post(new_post)
     
-    post_data = _serialize_post(new_post)
+    post_data = _post_payload(new_post)
     
     room_name = f'circle_{circle_id}_tl_{tl_id}' if tl_id != 0 else f'channel_{circle_id}'
     
-    print(f"DEBUG: Emitting 'new_post' to room {room_name} with data: {post_data}")
-    socketio.emit('new_post', post_data, room=room_name, namespace='/')
+    if presence.room_has_listeners(room_name):
+        print(f"DEBUG: Emitting 'new_post' to room {room_name} with data: {post_data}")
+        wire.emit('new_post', post_data, room_name)
+    _schedule_link_preview(new_post, link_url, cached_preview)
+    _schedule_post_media_variants(new_post)
 
     return jsonify({"message": "サークルに投稿が成功しました", "post": post_data}), 201
 
@@ -923,65 +1317,62 @@ def delete_post(post_id):
     if post.user_id != current_user.id:
         return jsonify({"error": "Unauthorized"}), 403
 
+    _delete_post_dependents(post.id)
     db.session.delete(post)
     db.session.commit()
+    feed_cache.invalidate_post(post)
 
-    if post.circle_id:
-        tl_id = post.private_tl_id or 0
-        room_name = f'circle_{post.circle_id}_tl_{tl_id}' if tl_id != 0 else f'channel_{post.circle_id}'
-        socketio.emit('post_deleted', {'post_id': post_id}, room=room_name, namespace='/')
-    elif post.channel_id:
-        socketio.emit('post_deleted', {'post_id': post_id}, room=f'channel_{post.channel_id}', namespace='/')
+    room_name = _room_for_post(post)
+    if presence.room_has_listeners(room_name):
+        wire.emit('post_deleted', {'post_id': post_id}, room_name)
     
     return jsonify({"message": "Post deleted successfully"})
 
 @community_bp.route('/posts/<int:post_id>/like', methods=['POST'])
 @login_required
+@rate_limited('like')
 def toggle_like(post_id):
     post = Post.query.get_or_404(post_id)
     
-    likes_list = post.likes or []
-    
-    if current_user.id in likes_list:
-        likes_list.remove(current_user.id)
+    # いいね済みなら削除、未いいねなら追加 (どちらも1文で原子的に行う)
+    removed = PostLike.query.filter_by(post_id=post.id, user_id=current_user.id).delete(synchronize_session=False)
+    if removed:
         is_liked = False
+        delta = -removed
     else:
-        likes_list.append(current_user.id)
+        delta = insert_ignore(PostLike, post_id=post.id, user_id=current_user.id, created_at=datetime.utcnow())
         is_liked = True
     
-    post.likes = likes_list
-    post.likes_count = len(likes_list)
-    
-    db.session.add(post)
+    if delta:
+        Post.query.filter_by(id=post.id).update(
+            {Post.likes_count: func.coalesce(Post.likes_count, 0) + delta, Post.version: Post.version + 1},
+            synchronize_session=False
+        )
     db.session.commit()
+    feed_cache.invalidate_post(post)
 
-    data_to_emit = {
-        'post_id': post.id,
-        'likes_count': post.likes_count,
-        'is_liked': is_liked
-    }
-    
-    if post.circle_id:
-        tl_id = post.private_tl_id or 0
-        room_name = f'circle_{post.circle_id}_tl_{tl_id}' if tl_id != 0 else f'channel_{post.circle_id}'
-        print(f"DEBUG: Emitting 'likes_updated' for post_id {post.id} to room {room_name}")
-        socketio.emit('likes_updated', data_to_emit, room=room_name, namespace='/')
-    elif post.channel_id:
-        print(f"DEBUG: Emitting 'likes_updated' for post_id {post.id} to room channel_{post.channel_id}")
-        socketio.emit('likes_updated', data_to_emit, room=f'channel_{post.channel_id}', namespace='/')
-    else:
-        print(f"DEBUG: Not emitting 'likes_updated' for post_id {post.id}. No associated room.")
+    # ルームへの通知は時間窓ごとにまとめて最新のいいね数だけを送る (is_liked は本人へのレスポンスのみ)
+    if delta:
+        realtime.queue_update('likes_updated', _room_for_post(post), post.id)
     
     return jsonify({"message": "Like toggled successfully", "likes_count": post.likes_count, "is_liked": is_liked})
 
 @community_bp.route('/posts/<int:post_id>/comments', methods=['GET', 'POST'])
 @login_required
+@rate_limited('comment')
 def handle_comments(post_id):
     post = Post.query.get_or_404(post_id)
     
     if request.method == 'GET':
-        comments = [{'username': c.user.username, 'content': c.content, 'created_at': c.created_at.strftime('%Y/%m/%d %H:%M'), 'user_id': c.user.id} for c in post.comments.order_by(Comment.created_at.asc()).all()]
-        return jsonify(comments)
+        # cursor より古いコメントを新しい順に取得し、表示用に古い順へ並べ替えて返す
+        limit = max(1, min(request.args.get('limit', type=int) or COMMENT_PAGE_SIZE, FEED_PAGE_SIZE_MAX))
+        comments = _fetch_page(
+            Comment.query.filter(Comment.post_id == post.id), request.args.get('cursor'), limit,
+            created_col=Comment.created_at, id_col=Comment.id
+        )
+        comments, next_cursor = _cut_page(comments, limit)
+        comments.reverse()
+        return jsonify(comments=_serialize_comments(comments), next_cursor=next_cursor)
     
     if request.method == 'POST':
         data = request.json
@@ -993,43 +1384,34 @@ def handle_comments(post_id):
         new_comment = Comment(content=content, post_id=post.id, user_id=current_user.id)
         db.session.add(new_comment)
         
-        post.comments_count += 1
+        Post.query.filter_by(id=post.id).update(
+            {Post.comments_count: func.coalesce(Post.comments_count, 0) + 1, Post.version: Post.version + 1},
+            synchronize_session=False
+        )
         db.session.commit()
+        feed_cache.invalidate_post(post)
         
-        comment_data = {
-            "post_id": post.id,
-            "comment": {
-                "id": new_comment.id,
-                "username": new_comment.user.username,
-                "content": new_comment.content,
-                "created_at": new_comment.created_at.strftime('%Y/%m/%d %H:%M'),
-                "user_id": new_comment.user.id,
-                "user_profile_picture_url": new_comment.user.profile_picture_url,
-                "is_liked": current_user.id in (new_comment.likes or []),
-                "likes_count": len(new_comment.likes or [])
-            },
-            "comments_count": post.comments_count
-        }
-        
-        if post.circle_id:
-            tl_id = post.private_tl_id or 0
-            room_name = f'circle_{post.circle_id}_tl_{tl_id}' if tl_id != 0 else f'channel_{post.circle_id}'
+        room_name = _room_for_post(post)
+        if presence.room_has_listeners(room_name):
+            comment_data = {
+                "post_id": post.id,
+                "comment": _serialize_comments([new_comment], with_viewer_state=False)[0],
+                "comments_count": post.comments_count
+            }
             print(f"DEBUG: Emitting 'new_comment' to room {room_name} with data: {comment_data}")
-            socketio.emit('new_comment', comment_data, room=room_name, namespace='/')
-        elif post.channel_id:
-            print(f"DEBUG: Emitting 'new_comment' to room channel_{post.channel_id} with data: {comment_data}")
-            socketio.emit('new_comment', comment_data, room=f'channel_{post.channel_id}', namespace='/')
+            wire.emit('new_comment', comment_data, room_name)
         else:
-            print(f"DEBUG: Not emitting 'new_comment' for post_id {post.id}. No associated room.")
+            metrics.incr('community.new_comment.skipped')
 
         return jsonify({"message": "Comment added successfully", "comment_id": new_comment.id})
 
 @community_bp.route('/comments/<int:comment_id>/like', methods=['POST'])
 @login_required
+@rate_limited('like')
 def toggle_comment_like(comment_id):
-    post = Post.query.get_or_404(comment_id)
+    comment = Comment.query.get_or_404(comment_id)
     
-    likes_list = post.likes or []
+    likes_list = list(comment.likes or [])
     
     if current_user.id in likes_list:
         likes_list.remove(current_user.id)
@@ -1038,102 +1420,110 @@ def toggle_comment_like(comment_id):
         likes_list.append(current_user.id)
         is_liked = True
     
-    post.likes = likes_list
-    post.likes_count = len(likes_list)
+    comment.likes = likes_list
     
-    db.session.add(post)
+    db.session.add(comment)
+    _bump_post_version(comment.post_id)
     db.session.commit()
+    feed_cache.invalidate_post(comment.post)
 
-    data_to_emit = {
-        'comment_id': comment.id,
-        'likes_count': len(likes_list),
-        'is_liked': is_liked
-    }
-    
-    if comment.post.circle_id:
-        post = comment.post
-        tl_id = post.private_tl_id or 0
-        room_name = f'circle_{post.circle_id}_tl_{tl_id}' if tl_id != 0 else f'channel_{post.circle_id}'
-        print(f"DEBUG: Emitting 'comment_likes_updated' for comment_id {comment.id} to room {room_name}")
-        socketio.emit('comment_likes_updated', data_to_emit, room=room_name, namespace='/')
-    elif comment.post.channel_id:
-        print(f"DEBUG: Emitting 'comment_likes_updated' for comment_id {comment.id} to room channel_{comment.post.channel_id}")
-        socketio.emit('comment_likes_updated', data_to_emit, room=f'channel_{comment.post.channel_id}', namespace='/')
+    realtime.queue_update('comment_likes_updated', _room_for_post(comment.post), comment.id)
     
     return jsonify({"message": "Comment like toggled successfully", "likes_count": len(likes_list), "is_liked": is_liked})
 
 @community_bp.route('/posts/<int:post_id>/react', methods=['POST'])
 @login_required
+@rate_limited('react')
 def toggle_reaction(post_id):
     post = Post.query.get_or_404(post_id)
     data = request.json
     emoji = data.get('emoji')
 
-    existing_reaction = Reaction.query.filter_by(user_id=current_user.id, post_id=post.id).first()
+    if not emoji:
+        return jsonify({"error": "emoji is required"}), 400
 
-    if existing_reaction:
-        if existing_reaction.emoji == emoji:
-            db.session.delete(existing_reaction)
-            action = 'removed'
-        else:
-            existing_reaction.emoji = emoji
-            action = 'updated'
+    # 同じ絵文字のリアクションがあれば取り消す
+    removed = Reaction.query.filter_by(user_id=current_user.id, post_id=post.id, emoji=emoji).delete(synchronize_session=False)
+    if removed:
+        action = 'removed'
+        count_deltas = {emoji: -1}
     else:
-        new_reaction = Reaction(user_id=current_user.id, post_id=post.id, emoji=emoji)
-        db.session.add(new_reaction)
-        action = 'added'
+        # 1ユーザー1投稿につき1リアクション: 別の絵文字があれば置き換える
+        replaced_emojis = db.session.execute(
+            delete(Reaction).where(
+                Reaction.user_id == current_user.id, Reaction.post_id == post.id, Reaction.emoji != emoji
+            ).returning(Reaction.emoji)
+        ).scalars().all()
+        inserted = insert_ignore(Reaction, user_id=current_user.id, post_id=post.id, emoji=emoji)
+        action = 'updated' if replaced_emojis else 'added'
+        count_deltas = {old_emoji: -1 for old_emoji in replaced_emojis}
+        count_deltas[emoji] = count_deltas.get(emoji, 0) + inserted
+
+    # 集計テーブルを同じトランザクションで更新
+    for changed_emoji, delta in count_deltas.items():
+        if delta:
+            upsert_increment(PostReactionCount, {'post_id': post.id, 'emoji': changed_emoji}, 'count', delta)
+    if any(delta < 0 for delta in count_deltas.values()):
+        PostReactionCount.query.filter(
+            PostReactionCount.post_id == post.id, PostReactionCount.count <= 0
+        ).delete(synchronize_session=False)
+    if any(count_deltas.values()):
+        _bump_post_version(post.id)
 
     db.session.commit()
+    feed_cache.invalidate_post(post)
 
-    reaction_counts = {}
-    for reaction in post.reactions:
-        reaction_counts[reaction.emoji] = reaction_counts.get(reaction.emoji, 0) + 1
-        
-    data_to_emit = {
-        'post_id': post.id,
-        'reaction_counts': reaction_counts,
-        'user_id': current_user.id,
-        'emoji': emoji,
-        'action': action
-    }
-    
-    if post.circle_id:
-        tl_id = post.private_tl_id or 0
-        room_name = f'circle_{post.circle_id}_tl_{tl_id}' if tl_id != 0 else f'channel_{post.circle_id}'
-        print(f"DEBUG: Emitting 'reaction_updated' to room {room_name} with data: {data_to_emit}")
-        socketio.emit('reaction_updated', data_to_emit, room=room_name, namespace='/')
-    elif post.channel_id:
-        print(f"DEBUG: Emitting 'reaction_updated' to room channel_{post.channel_id} with data: {data_to_emit}")
-        socketio.emit('reaction_updated', data_to_emit, room=f'channel_{post.channel_id}', namespace='/')
-    else:
-        print(f"DEBUG: Not emitting 'reaction_updated' for post_id {post.id}. No associated room.")
+    reaction_counts = _load_reaction_counts([post.id]).get(post.id, {})
+
+    if any(count_deltas.values()):
+        realtime.queue_update('reaction_updated', _room_for_post(post), post.id)
 
     return jsonify({"message": f"Reaction {action} successfully", "reaction_counts": reaction_counts})
 
 @community_bp.route('/user/<int:user_id>/follow', methods=['POST'])
 @login_required
+@rate_limited('follow')
 def follow_user(user_id):
     if user_id == current_user.id:
         return jsonify({"error": "自分自身をフォローすることはできません。"})
 
     user_to_follow = User.query.get_or_404(user_id)
     
-    if user_to_follow.id not in (current_user.following_ids or []):
-        if current_user.following_ids is None:
-            current_user.following_ids = []
-        current_user.following_ids.append(user_to_follow.id)
-        if user_to_follow.follower_ids is None:
-            user_to_follow.follower_ids = []
-        user_to_follow.follower_ids.append(current_user.id)
-        db.session.commit()
-        return jsonify({"message": "フォローしました", "status": "followed"}), 200
-    else:
-        current_user.following_ids.remove(user_to_follow.id)
-        if current_user.id in (user_to_follow.follower_ids or []):
-            user_to_follow.follower_ids.remove(current_user.id)
+    # フォロー済みなら解除、未フォローならフォロー (どちらも1文で原子的に行う)
+    removed = Follow.query.filter_by(follower_id=current_user.id, followed_id=user_to_follow.id).delete(synchronize_session=False)
+    if removed:
+        timeline.on_unfollow(current_user.id, user_to_follow.id)
+        User.query.filter_by(id=user_to_follow.id).update(
+            {User.followers_count: User.followers_count - removed}, synchronize_session=False
+        )
         db.session.commit()
         return jsonify({"message": "フォローを解除しました", "status": "unfollowed"}), 200
 
+    inserted = insert_ignore(Follow, follower_id=current_user.id, followed_id=user_to_follow.id, timestamp=datetime.utcnow())
+    if inserted:
+        timeline.on_follow(current_user.id, user_to_follow)
+        User.query.filter_by(id=user_to_follow.id).update(
+            {User.followers_count: User.followers_count + inserted}, synchronize_session=False
+        )
+    db.session.commit()
+    return jsonify({"message": "フォローしました", "status": "followed"}), 200
+
+@community_bp.route('/api/users/online', methods=['GET'])
+@login_required
+def get_online_users():
+    """
+    指定したユーザーのオンライン状態を返すAPI
+    ids: カンマ区切りのユーザーID (最大100件)
+    """
+    user_ids = []
+    for value in request.args.get('ids', '').split(',')[:100]:
+        try:
+            user_ids.append(int(value))
+        except ValueError:
+            continue
+    online_ids = presence.online_user_ids(user_ids)
+    return jsonify(online={str(user_id): user_id in online_ids for user_id in user_ids})
+
 @community_bp.route('/api/users/search', methods=['GET'])
 @login_required
 def search_users():
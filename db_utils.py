@@ -0,0 +1,36 @@
+# db_utils.py
+"""
+DB方言の差異を吸収するヘルパー
+SQLite (開発環境) と PostgreSQL の ON CONFLICT 構文に対応する
+"""
+from sqlalchemy.dialects import postgresql, sqlite
+from extensions import db
+
+
+def dialect_insert(model):
+    """現在のDB方言の insert() (on_conflict_do_* が使える) を返す"""
+    if db.session.get_bind().dialect.name == 'postgresql':
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
+
+def insert_ignore(model, **values):
+    """
+    一意制約に衝突する場合は何もしないINSERTを実行する。
+    挿入された行数 (0 or 1) を返す
+    """
+    stmt = dialect_insert(model).values(**values).on_conflict_do_nothing()
+    return db.session.execute(stmt).rowcount
+
+
+def upsert_increment(model, key_values, column_name, delta):
+    """
+    key_values の行の column_name を delta だけ加算する。行がなければ delta で作成する。
+    読み込み→書き込みをせず、1文で原子的に更新する
+    """
+    column = getattr(model, column_name)
+    stmt = dialect_insert(model).values(**key_values, **{column_name: delta}).on_conflict_do_update(
+        index_elements=list(key_values.keys()),
+        set_={column_name: column + delta}
+    )
+    db.session.execute(stmt)
@@ -2,9 +2,17 @@
 
 from flask import Blueprint, render_template, request, jsonify
 from flask_login import login_required, current_user
-from sqlalchemy import or_
+from sqlalchemy import or_, and_, case, func
+from sqlalchemy.orm import aliased
 from flask_socketio import emit, join_room, leave_room
 from datetime import datetime
+import os
+from blocking import run_blocking
+from feed_cache import TTLCache
+import dm_writer
+from rate_limit import allow_socket_event
+import presence
+import wire
 
 # dm_bpルートの定義
 dm_bp = Blueprint('dm', __name__, url_prefix='/dm')
@@ -12,133 +20,283 @@ dm_bp = Blueprint('dm', __name__, url_prefix='/dm')
 # SocketIOインスタンスをグローバル変数として保持
 socketio = None
 
+# (小さいユーザーID, 大きいユーザーID) → 会話ID のキャッシュ (会話IDは作成後に変わらない)
+DM_CONVERSATION_CACHE_MAX_ENTRIES = int(os.environ.get('DM_CONVERSATION_CACHE_MAX_ENTRIES', 10000))
+DM_CONVERSATION_CACHE_TTL = 3600
+_conversation_ids = TTLCache(DM_CONVERSATION_CACHE_MAX_ENTRIES, DM_CONVERSATION_CACHE_TTL)
+
 def init_dm_socketio(sio_instance):
     """DM機能のSocketIOイベントハンドラを登録する関数"""
     global socketio
     socketio = sio_instance
     
-    @socketio.on('connect', namespace='/')
-    def handle_connect():
-        # 💡Import models here to break the circular import loop💡
-        from models import DirectMessageConversation, DirectMessage, User, db
-        
-        if not current_user.is_authenticated:
-            return False
-        join_room(f'user_{current_user.id}')
+    # connect / disconnect は presence.init_presence で登録する
     
     @socketio.on('join_dm_room', namespace='/')
     def handle_join_dm_room(data):
-        # 💡Import models here💡
-        from models import DirectMessageConversation, DirectMessage, User, db
-        
         if not current_user.is_authenticated:
             return
         conversation_id = data.get('conversation_id')
-        if conversation_id:
+        if conversation_id and run_blocking(_is_conversation_member, current_user.id, conversation_id):
             room_name = f'conversation_{conversation_id}'
-            join_room(room_name)
+            presence.join(request.sid, room_name)
             print(f'User {current_user.id} joined room: {room_name}')
 
     @socketio.on('send_dm', namespace='/')
     def handle_send_dm(data):
-        # 💡Import models here💡
-        from models import DirectMessageConversation, DirectMessage, User, db
-        
         if not current_user.is_authenticated:
             return
+        if not allow_socket_event('send_dm'):
+            return
         
         recipient_id = data.get('recipient_id')
         content = data.get('content')
         
         if not recipient_id or not content:
             return
-            
-        conv = DirectMessageConversation.query.filter(
-            or_(
-                (DirectMessageConversation.user1_id == current_user.id) & (DirectMessageConversation.user2_id == recipient_id),
-                (DirectMessageConversation.user1_id == recipient_id) & (DirectMessageConversation.user2_id == current_user.id)
-            )
-        ).first()
-
-        if not conv:
-            conv = DirectMessageConversation(user1_id=current_user.id, user2_id=recipient_id)
-            db.session.add(conv)
-            db.session.commit()
-
-        new_message = DirectMessage(
-            conversation_id=conv.id,
-            sender_id=current_user.id,
-            recipient_id=recipient_id,
-            content=content
-        )
-        db.session.add(new_message)
-        db.session.commit()
+        try:
+            recipient_id = int(recipient_id)
+        except (TypeError, ValueError):
+            return
         
-        message_data = {
-            'sender_id': current_user.id,
-            'content': new_message.content,
-            'timestamp': new_message.timestamp.isoformat()
-        }
+        # DBへの書き込みはイベントループを止めないようスレッドプールで行う
+        if dm_writer.DM_WRITE_BEHIND:
+            # 会話IDだけ確定させて即座に配信し、メッセージの保存はライターにまとめて任せる
+            conversation_id = run_blocking(get_or_create_conversation_id, current_user.id, recipient_id)
+            message_data = _message_payload(dm_writer.enqueue(conversation_id, current_user.id, recipient_id, content))
+        else:
+            conversation_id, message_data = run_blocking(_save_direct_message, current_user.id, recipient_id, content)
         
         # 参加しているルームにメッセージを送信
-        emit('receive_dm', message_data, room=f'conversation_{conv.id}', namespace='/')
+        wire.emit('receive_dm', message_data, f'conversation_{conversation_id}')
+
+def _is_conversation_member(user_id, conversation_id):
+    """user_id が会話の当事者か (run_blocking 経由で呼ぶ)"""
+    # 💡Import models here💡
+    from models import DirectMessageConversation
+    
+    try:
+        conversation_id = int(conversation_id)
+    except (TypeError, ValueError):
+        return False
+    conv = DirectMessageConversation.query.get(conversation_id)
+    return conv is not None and user_id in (conv.user1_id, conv.user2_id)
+
+def conversation_pair(user_a_id, user_b_id):
+    """会話は常に (小さいID, 大きいID) の順で user1_id / user2_id に保存する"""
+    return (min(user_a_id, user_b_id), max(user_a_id, user_b_id))
+
+def find_conversation_id(user_a_id, user_b_id):
+    """2人の会話IDを返す (なければ None)。_user_pair_uc の一意インデックスを1回引くだけで済む"""
+    # 💡Import models here💡
+    from models import DirectMessageConversation, db
+    
+    pair = conversation_pair(user_a_id, user_b_id)
+    conversation_id = _conversation_ids.get(pair)
+    if conversation_id is None:
+        conversation_id = db.session.query(DirectMessageConversation.id).filter_by(
+            user1_id=pair[0], user2_id=pair[1]
+        ).scalar()
+        if conversation_id is not None:
+            _conversation_ids.set(pair, conversation_id)
+    return conversation_id
+
+def get_or_create_conversation_id(user_a_id, user_b_id):
+    """2人の会話IDを返す。なければ作成する (同時に作成されても一意制約で1件にまとまる)"""
+    # 💡Import models here💡
+    from models import DirectMessageConversation, db
+    from db_utils import insert_ignore
+    
+    conversation_id = find_conversation_id(user_a_id, user_b_id)
+    if conversation_id is None:
+        user1_id, user2_id = conversation_pair(user_a_id, user_b_id)
+        insert_ignore(DirectMessageConversation, user1_id=user1_id, user2_id=user2_id)
+        db.session.commit()
+        conversation_id = find_conversation_id(user_a_id, user_b_id)
+    return conversation_id
+
+def _save_direct_message(sender_id, recipient_id, content):
+    """DMを保存し、(会話ID, 送信用データ) を返す (run_blocking 経由で呼ぶ)"""
+    # 💡Import models here💡
+    from models import DirectMessageConversation, DirectMessage, db
+    
+    conversation_id = get_or_create_conversation_id(sender_id, recipient_id)
+
+    new_message = DirectMessage(
+        message_uid=dm_writer.new_message_uid(),
+        conversation_id=conversation_id,
+        sender_id=sender_id,
+        recipient_id=recipient_id,
+        content=content
+    )
+    db.session.add(new_message)
+    db.session.flush()
+    DirectMessageConversation.query.filter_by(id=conversation_id).update({
+        DirectMessageConversation.last_message_id: new_message.id,
+        DirectMessageConversation.last_message_at: new_message.timestamp
+    }, synchronize_session=False)
+    db.session.commit()
+    
+    return conversation_id, _message_payload({
+        'message_uid': new_message.message_uid,
+        'sender_id': sender_id,
+        'content': new_message.content,
+        'timestamp': new_message.timestamp
+    })
+
+def _message_payload(message):
+    """receive_dm で送信するデータ (message は保存する行の値の dict)"""
+    return {
+        'message_uid': message['message_uid'],
+        'sender_id': message['sender_id'],
+        'content': message['content'],
+        'timestamp': message['timestamp'].isoformat(),
+        'created_ts': wire.epoch_seconds(message['timestamp'])
+    }
+
+# 受信箱1ページあたりの会話数
+DM_INBOX_PAGE_SIZE = 30
+DM_INBOX_PAGE_SIZE_MAX = 100
+# チャット履歴1ページあたりのメッセージ数
+DM_HISTORY_PAGE_SIZE = 50
+DM_HISTORY_PAGE_SIZE_MAX = 200
+
+def _encode_dm_cursor(timestamp, row_id):
+    return f"{timestamp.isoformat()}_{row_id}"
+
+def _decode_dm_cursor(cursor):
+    """受信箱・チャット履歴のカーソル文字列を (日時, ID) に戻す。不正な値の場合は None"""
+    if not cursor:
+        return None
+    try:
+        timestamp_str, row_id_str = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(timestamp_str), int(row_id_str)
+    except (ValueError, TypeError):
+        return None
 
 # DMリストを取得するAPI
 @dm_bp.route('/api/dms', methods=['GET'])
 @login_required
 def get_dm_list():
+    """
+    受信箱 (最終メッセージの新しい順)。相手ユーザー・最新メッセージ・未読数を1クエリで取得する
+    cursor: 前ページのnext_cursor, limit: 1ページの件数
+    """
+    # 💡Import models here💡
+    from models import DirectMessageConversation, DirectMessage, User, db
+    
+    # このプロセスで保存待ちのメッセージを先に保存する (ライトビハインド時)
+    dm_writer.flush_for_read()
+    limit = max(1, min(request.args.get('limit', type=int) or DM_INBOX_PAGE_SIZE, DM_INBOX_PAGE_SIZE_MAX))
+    conversation = DirectMessageConversation
+    other_user_id = case((conversation.user1_id == current_user.id, conversation.user2_id), else_=conversation.user1_id)
+    unread_message = aliased(DirectMessage)
+    unread_count = db.session.query(func.count(unread_message.id)).filter(
+        unread_message.conversation_id == conversation.id,
+        unread_message.recipient_id == current_user.id,
+        unread_message.is_read == False
+    ).correlate(conversation).scalar_subquery()
+
+    query = db.session.query(
+        conversation.id.label('conversation_id'),
+        conversation.last_message_at,
+        User.id.label('user_id'),
+        User.username,
+        User.profile_picture_url,
+        DirectMessage.content.label('last_message'),
+        unread_count.label('unread_count')
+    ).join(User, User.id == other_user_id).join(
+        DirectMessage, DirectMessage.id == conversation.last_message_id
+    ).filter(
+        or_(conversation.user1_id == current_user.id, conversation.user2_id == current_user.id)
+    )
+
+    decoded = _decode_dm_cursor(request.args.get('cursor'))
+    if decoded:
+        cursor_last_message_at, cursor_id = decoded
+        query = query.filter(or_(
+            conversation.last_message_at < cursor_last_message_at,
+            and_(conversation.last_message_at == cursor_last_message_at, conversation.id < cursor_id)
+        ))
+    rows = query.order_by(conversation.last_message_at.desc(), conversation.id.desc()).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_dm_cursor(rows[-1].last_message_at, rows[-1].conversation_id)
+
+    dm_list = [{
+        'conversation_id': row.conversation_id,
+        'user_id': row.user_id,
+        'username': row.username,
+        'profile_picture_url': row.profile_picture_url,
+        'last_message': row.last_message,
+        'last_message_timestamp': row.last_message_at.strftime('%Y/%m/%d %H:%M'),
+        'unread_count': row.unread_count
+    } for row in rows]
+    return jsonify(dms=dm_list, next_cursor=next_cursor)
+
+# 会話を既読にするAPI (チャットを開いている間に受信したメッセージ用)
+@dm_bp.route('/api/conversations/<int:conversation_id>/read', methods=['POST'])
+@login_required
+def mark_conversation_read(conversation_id):
     # 💡Import models here💡
-    from models import DirectMessageConversation, DirectMessage, User
+    from models import DirectMessage, db
     
-    conversations = DirectMessageConversation.query.filter(
-        or_(
-            DirectMessageConversation.user1_id == current_user.id,
-            DirectMessageConversation.user2_id == current_user.id
-        )
-    ).all()
-
-    dm_list = []
-    for conv in conversations:
-        other_user_id = conv.user1_id if conv.user2_id == current_user.id else conv.user2_id
-        other_user = User.query.get(other_user_id)
-        last_message = DirectMessage.query.filter_by(conversation_id=conv.id).order_by(DirectMessage.timestamp.desc()).first()
-
-        if other_user:
-            dm_list.append({
-                'conversation_id': conv.id,
-                'user_id': other_user.id,
-                'username': other_user.username,
-                'profile_picture_url': other_user.profile_picture_url,
-                'last_message': last_message.content if last_message else '新しいDM',
-                'last_message_timestamp': last_message.timestamp.strftime('%Y/%m/%d %H:%M') if last_message else None
-            })
-    return jsonify(dms=dm_list)
+    dm_writer.flush_for_read()
+    DirectMessage.query.filter_by(
+        conversation_id=conversation_id, recipient_id=current_user.id, is_read=False
+    ).update({DirectMessage.is_read: True}, synchronize_session=False)
+    db.session.commit()
+    return jsonify({"message": "既読にしました"})
 
 # 特定ユーザーとのチャット履歴のAPIエンドポイント
 @dm_bp.route('/api/dms/<int:user_id>/messages', methods=['GET'])
 @login_required
 def get_dm_history(user_id):
     # 💡Import models here💡
-    from models import DirectMessageConversation, DirectMessage
+    from models import DirectMessage, db
     
-    conv = DirectMessageConversation.query.filter(
-        or_(
-            (DirectMessageConversation.user1_id == current_user.id) & (DirectMessageConversation.user2_id == user_id),
-            (DirectMessageConversation.user1_id == user_id) & (DirectMessageConversation.user2_id == current_user.id)
-        )
-    ).first()
+    conversation_id = find_conversation_id(current_user.id, user_id)
+    if conversation_id is None:
+        return jsonify(messages=[], conversation_id=None, next_cursor=None)
+
+    # このプロセスで保存待ちのメッセージを先に保存する (ライトビハインド時)
+    dm_writer.flush_for_read()
+    limit = max(1, min(request.args.get('limit', type=int) or DM_HISTORY_PAGE_SIZE, DM_HISTORY_PAGE_SIZE_MAX))
+    decoded = _decode_dm_cursor(request.args.get('cursor'))
+    if not decoded:
+        # 履歴を開いたら自分宛ての未読メッセージを既読にする (最新ページのときだけ)
+        DirectMessage.query.filter_by(
+            conversation_id=conversation_id, recipient_id=current_user.id, is_read=False
+        ).update({DirectMessage.is_read: True}, synchronize_session=False)
+        db.session.commit()
 
-    if not conv:
-        return jsonify(messages=[], conversation_id=None)
+    # 新しい順に limit 件 (cursor 指定時はそれより古いもの) を ix_dm_conversation_timestamp で取得する
+    query = DirectMessage.query.filter(DirectMessage.conversation_id == conversation_id)
+    if decoded:
+        cursor_timestamp, cursor_id = decoded
+        query = query.filter(or_(
+            DirectMessage.timestamp < cursor_timestamp,
+            and_(DirectMessage.timestamp == cursor_timestamp, DirectMessage.id < cursor_id)
+        ))
+    messages = query.order_by(DirectMessage.timestamp.desc(), DirectMessage.id.desc()).limit(limit + 1).all()
 
-    messages = DirectMessage.query.filter_by(conversation_id=conv.id).order_by(DirectMessage.timestamp.asc()).all()
+    next_cursor = None
+    if len(messages) > limit:
+        messages = messages[:limit]
+        next_cursor = _encode_dm_cursor(messages[-1].timestamp, messages[-1].id)
+
+    # 表示は古い順
     messages_list = [{
+        'id': msg.id,
+        'message_uid': msg.message_uid,
         'sender_id': msg.sender_id,
         'content': msg.content,
         'timestamp': msg.timestamp.strftime('%Y/%m/%d %H:%M')
-    } for msg in messages]
+    } for msg in reversed(messages)]
 
-    return jsonify(messages=messages_list, conversation_id=conv.id)
+    return jsonify(messages=messages_list, conversation_id=conversation_id, next_cursor=next_cursor)
 
 
 # 特定ユーザーとのチャットページ
@@ -146,18 +304,11 @@ def get_dm_history(user_id):
 @login_required
 def get_chat_page(user_id):
     # 💡Import models here💡
-    from models import DirectMessageConversation, User
+    from models import User
     
     other_user = User.query.get_or_404(user_id)
     
     # 会話IDをテンプレートに渡す
-    conversation = DirectMessageConversation.query.filter(
-        or_(
-            (DirectMessageConversation.user1_id == current_user.id) & (DirectMessageConversation.user2_id == user_id),
-            (DirectMessageConversation.user1_id == user_id) & (DirectMessageConversation.user2_id == current_user.id)
-        )
-    ).first()
-    
-    conversation_id = conversation.id if conversation else None
+    conversation_id = find_conversation_id(current_user.id, user_id)
     
     return render_template('chat_page.html', other_user=other_user, current_user_id=current_user.id, conversation_id=conversation_id)
\ No newline at end of file
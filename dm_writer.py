@@ -0,0 +1,285 @@
+# dm_writer.py
+"""
+DMメッセージのライトビハインド (書き込みの遅延・まとめ書き)
+
+DM_WRITE_BEHIND=1 の場合、send_dm ではメッセージにサーバー側で message_uid を振ってすぐに配信し、
+DBへの保存はバックグラウンドのライターが一定間隔 (DM_WRITE_BEHIND_FLUSH_MS) ごとに1トランザクションでまとめて行う。
+グループチャットなどで短時間に多数のメッセージが送られても、コミットはメッセージ数ではなく間隔ごとの1回で済む。
+
+保存の保証:
+- 保存に失敗したメッセージはキューに戻し、再試行する (message_uid の一意制約で二重保存しない)
+- DBに接続できない・ロックされているなどの一時的なエラー (OperationalError など) では、メッセージを捨てずに
+  キューに残したまま間隔を延ばして (最大 DM_WRITE_BEHIND_MAX_BACKOFF_MS) 再試行する
+- データのエラー (IntegrityError / DataError など) で DM_WRITE_BEHIND_MAX_ATTEMPTS 回続けて失敗したまとめは1件ずつ保存し直し、
+  それでも保存できないメッセージだけを DM_DEAD_LETTER_PATH (JSON Lines の追記ファイル) へ移す。
+  1件の不正なメッセージがキュー全体を止め続けないようにする
+- プロセスの正常終了時 (SIGINT、gunicorn の graceful shutdown など) に atexit で残りを保存する
+- 同じプロセスでの履歴・受信箱の読み込み前に flush_for_read() し、送信者が自分のメッセージを見失わないようにする
+  (保存に失敗しても読み込みは止めず、保存済みの分を返す)
+プロセスが強制終了した場合は、最後の間隔分のメッセージが失われうる (既定の同期保存モードではこの遅延はない)。
+"""
+import os
+import json
+import time
+import atexit
+import threading
+import uuid
+from datetime import datetime
+from sqlalchemy.exc import OperationalError, InterfaceError, DisconnectionError, DBAPIError, IntegrityError, DataError
+import metrics
+from blocking import run_blocking
+from db_utils import dialect_insert
+from extensions import db
+
+DM_WRITE_BEHIND = os.environ.get('DM_WRITE_BEHIND') == '1'
+# まとめて保存する間隔 (ミリ秒) と1トランザクションあたりの最大件数
+DM_WRITE_BEHIND_FLUSH_MS = int(os.environ.get('DM_WRITE_BEHIND_FLUSH_MS', 200))
+DM_WRITE_BEHIND_BATCH_SIZE = int(os.environ.get('DM_WRITE_BEHIND_BATCH_SIZE', 500))
+# データのエラーでまとめての保存を何回失敗したら1件ずつに切り替えるか
+DM_WRITE_BEHIND_MAX_ATTEMPTS = int(os.environ.get('DM_WRITE_BEHIND_MAX_ATTEMPTS', 3))
+# 一時的なエラーが続いたときの再試行間隔の上限 (ミリ秒)
+DM_WRITE_BEHIND_MAX_BACKOFF_MS = int(os.environ.get('DM_WRITE_BEHIND_MAX_BACKOFF_MS', 30000))
+# 保存できなかったメッセージの追記先 (再起動後も残る)
+DM_DEAD_LETTER_PATH = os.environ.get('DM_DEAD_LETTER_PATH') or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'dm_dead_letters.jsonl'
+)
+
+_lock = threading.Lock()
+# 一度に flush() するのは1スレッドだけにする (キューに戻したメッセージの順序を保つため)
+_flush_lock = threading.Lock()
+# DM_DEAD_LETTER_PATH への追記用
+_dead_letter_lock = threading.Lock()
+_pending = []
+# message_uid → データのエラーで保存に失敗した回数
+_attempts = {}
+# 一時的なエラーが続いた回数と、次に保存を試みてよい時刻 (time.monotonic())
+_transient_failures = 0
+_retry_at = 0.0
+_app = None
+_worker_started = False
+
+
+def new_message_uid():
+    """メッセージに振るサーバー側のID (保存前から配信・重複排除に使える)"""
+    return uuid.uuid4().hex
+
+
+def enqueue(conversation_id, sender_id, recipient_id, content):
+    """メッセージを保存待ちキューに追加し、保存される行の値 (dict) を返す"""
+    record = {
+        'message_uid': new_message_uid(),
+        'conversation_id': conversation_id,
+        'sender_id': sender_id,
+        'recipient_id': recipient_id,
+        'content': content,
+        'timestamp': datetime.utcnow(),
+        'is_read': False,
+    }
+    with _lock:
+        _pending.append(record)
+    metrics.incr('dm_writer.queued')
+    return record
+
+
+def pending_count():
+    with _lock:
+        return len(_pending)
+
+
+def dead_letters():
+    """保存できずにキューから外したメッセージの一覧 (古い順。DM_DEAD_LETTER_PATH から読む)"""
+    if not os.path.exists(DM_DEAD_LETTER_PATH):
+        return []
+    with open(DM_DEAD_LETTER_PATH, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _is_transient(error):
+    """DBに接続できない・ロック中など、時間をおけば成功しうるエラーか"""
+    if isinstance(error, (OperationalError, InterfaceError, DisconnectionError)):
+        return True
+    return isinstance(error, DBAPIError) and error.connection_invalidated
+
+
+def in_backoff():
+    """一時的なエラーの後で、再試行を待っている間か"""
+    return time.monotonic() < _retry_at
+
+
+def _record_transient_failure():
+    global _transient_failures, _retry_at
+    with _lock:
+        _transient_failures += 1
+        delay_ms = min(DM_WRITE_BEHIND_FLUSH_MS * (2 ** _transient_failures), DM_WRITE_BEHIND_MAX_BACKOFF_MS)
+        _retry_at = time.monotonic() + delay_ms / 1000.0
+    metrics.incr('dm_writer.transient_errors')
+
+
+def _reset_backoff():
+    global _transient_failures, _retry_at
+    if _transient_failures:
+        with _lock:
+            _transient_failures = 0
+            _retry_at = 0.0
+
+
+def _dead_letter(record, error):
+    """保存できないメッセージをログに出し、DM_DEAD_LETTER_PATH へ追記する"""
+    entry = dict(record, timestamp=record['timestamp'].isoformat(), error=str(error),
+                 dropped_at=datetime.utcnow().isoformat())
+    with _dead_letter_lock:
+        with open(DM_DEAD_LETTER_PATH, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+    print(f"DM write-behind dropped message {record['message_uid']} "
+          f"(conversation {record['conversation_id']}, sender {record['sender_id']}): {error}")
+    metrics.incr('dm_writer.dead_letters')
+
+
+def _write_batch(records):
+    """records を1トランザクションで保存し、会話ごとの最新メッセージを更新する"""
+    # 💡Import models here💡
+    from models import DirectMessage, DirectMessageConversation
+
+    db.session.execute(dialect_insert(DirectMessage).on_conflict_do_nothing(), records)
+    latest = {}
+    for record in records:
+        latest[record['conversation_id']] = record
+    for conversation_id, record in latest.items():
+        last_message_id = db.select(DirectMessage.id).where(
+            DirectMessage.message_uid == record['message_uid']
+        ).scalar_subquery()
+        DirectMessageConversation.query.filter_by(id=conversation_id).update({
+            DirectMessageConversation.last_message_id: last_message_id,
+            DirectMessageConversation.last_message_at: record['timestamp']
+        }, synchronize_session=False)
+    db.session.commit()
+
+
+def _write_one_by_one(batch):
+    """
+    まとめて保存できなかった batch を1件ずつ保存し、データのエラー (IntegrityError / DataError) で
+    保存できないメッセージだけを DM_DEAD_LETTER_PATH へ移す。
+    それ以外のエラーの場合は、そのメッセージ以降の未保存分を返す (呼び出し側でキューに戻す)。すべて処理できたら空リスト
+    """
+    written = 0
+    try:
+        for index, record in enumerate(batch):
+            try:
+                _write_batch([record])
+                written += 1
+            except Exception as e:
+                db.session.rollback()
+                if not isinstance(e, (IntegrityError, DataError)):
+                    return batch[index:]
+                try:
+                    _dead_letter(record, e)
+                except OSError as write_error:
+                    print(f"DM write-behind could not record dead letter {record['message_uid']}: {write_error}")
+                    return batch[index:]
+            with _lock:
+                _attempts.pop(record['message_uid'], None)
+        return []
+    finally:
+        metrics.incr('dm_writer.written', written)
+
+
+def flush():
+    """
+    保存待ちのメッセージをすべて保存する (アプリケーションコンテキスト内で呼ぶ)。
+    失敗した場合は未保存分をキューの先頭に戻して例外を送出する。
+    データのエラーで DM_WRITE_BEHIND_MAX_ATTEMPTS 回失敗したまとめは1件ずつ保存し、保存できないものだけをキューから外す
+    """
+    if not DM_WRITE_BEHIND:
+        return
+    with _flush_lock:
+        with _lock:
+            records = _pending[:]
+            del _pending[:]
+        for start in range(0, len(records), DM_WRITE_BEHIND_BATCH_SIZE):
+            batch = records[start:start + DM_WRITE_BEHIND_BATCH_SIZE]
+            try:
+                _write_batch(batch)
+            except Exception as e:
+                db.session.rollback()
+                metrics.incr('dm_writer.flush_errors')
+                if _is_transient(e):
+                    # メッセージは数えずにキューに残し、間隔を延ばして再試行する
+                    _record_transient_failure()
+                    with _lock:
+                        _pending[:0] = records[start:]
+                    raise
+                with _lock:
+                    attempts = max(_attempts.get(record['message_uid'], 0) + 1 for record in batch)
+                    for record in batch:
+                        _attempts[record['message_uid']] = attempts
+                if attempts >= DM_WRITE_BEHIND_MAX_ATTEMPTS:
+                    unsaved = _write_one_by_one(batch)
+                    if not unsaved:
+                        _reset_backoff()
+                        continue
+                    _record_transient_failure()
+                    with _lock:
+                        _pending[:0] = unsaved + records[start + len(batch):]
+                    raise
+                with _lock:
+                    _pending[:0] = records[start:]
+                raise
+            _reset_backoff()
+            if _attempts:
+                with _lock:
+                    for record in batch:
+                        _attempts.pop(record['message_uid'], None)
+            metrics.incr('dm_writer.batches')
+            metrics.incr('dm_writer.written', len(batch))
+
+
+def flush_for_read():
+    """
+    読み込み系のリクエストの前に呼ぶ flush()。保存に失敗してもリクエストは止めず、
+    保存済みのメッセージだけで応答できるようにする (未保存分はバックグラウンドで再試行される)
+    """
+    if in_backoff():
+        return
+    try:
+        flush()
+    except Exception as e:
+        metrics.incr('dm_writer.read_flush_errors')
+        print(f"DM write-behind flush before read failed ({pending_count()} messages pending): {e}")
+
+
+def _flush_on_exit():
+    if not pending_count():
+        return
+    try:
+        with _app.app_context():
+            try:
+                flush()
+            finally:
+                db.session.remove()
+    except Exception as e:
+        print(f"DM write-behind flush on exit failed ({pending_count()} messages): {e}")
+
+
+def start_dm_writer(app, socketio):
+    """ライトビハインド有効時に、定期的に保存するバックグラウンドタスクを開始する (1プロセスにつき1回)"""
+    global _app, _worker_started
+    if not DM_WRITE_BEHIND:
+        return
+    with _lock:
+        if _worker_started:
+            return
+        _worker_started = True
+    _app = app
+    atexit.register(_flush_on_exit)
+
+    def worker():
+        while True:
+            socketio.sleep(DM_WRITE_BEHIND_FLUSH_MS / 1000.0)
+            if not pending_count() or in_backoff():
+                continue
+            try:
+                run_blocking(flush)
+            except Exception as e:
+                print(f"DM write-behind flush failed: {e}")
+
+    socketio.start_background_task(worker)
@@ -0,0 +1,159 @@
+# feed_cache.py
+"""
+フィードページのレスポンスキャッシュ
+
+公開フィード・サークルTL・プロフィールの投稿一覧を、閲覧者に依存しない形でキャッシュする。
+キャッシュキーには対象範囲 (scope) ごとのバージョンを含め、投稿・いいね・コメント・リアクションの
+書き込み時にバージョンを上げることで、古いエントリを参照されなくする (古いエントリはLRUで追い出される)。
+いいね状態などの閲覧者ごとの値は、キャッシュ取得後に呼び出し側で上書きする。
+
+あわせて、投稿1件分のシリアライズ結果 (フラグメント) を (投稿ID, Post.version) をキーにキャッシュし、
+異なるフィード・閲覧者・ソケット配信の間で同じ投稿を何度もシリアライズしないようにする。
+
+キャッシュ本体はプロセスごとに持つ。バージョンは REDIS_URL が設定されていれば Redis に置き、
+どのワーカーでの書き込みも全ワーカーのキャッシュを無効にする (未設定時はプロセス内に保持する)。
+"""
+import os
+import time
+import threading
+from collections import OrderedDict
+from shared_store import get_redis
+
+# エントリの有効秒数 (バージョン更新が届かない変更 (ユーザー名変更など) の反映遅延の上限)
+FEED_CACHE_TTL = int(os.environ.get('FEED_CACHE_TTL', 30))
+# 保持するエントリ数の上限
+FEED_CACHE_MAX_ENTRIES = int(os.environ.get('FEED_CACHE_MAX_ENTRIES', 1024))
+# 投稿フラグメントの保持数と有効秒数 (Post.version が上がらない変更 (ユーザー名変更など) の反映遅延の上限)
+POST_FRAGMENT_CACHE_MAX_ENTRIES = int(os.environ.get('POST_FRAGMENT_CACHE_MAX_ENTRIES', 5000))
+POST_FRAGMENT_TTL = int(os.environ.get('POST_FRAGMENT_TTL', 300))
+
+PUBLIC_SCOPE = 'public'
+
+
+class TTLCache:
+    """有効期限つきのLRUキャッシュ (スレッドセーフ)"""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= now:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_lock = threading.Lock()
+_versions = {}
+_pages = TTLCache(FEED_CACHE_MAX_ENTRIES, FEED_CACHE_TTL)
+_post_fragments = TTLCache(POST_FRAGMENT_CACHE_MAX_ENTRIES, POST_FRAGMENT_TTL)
+
+
+def circle_scope(circle_id, tl_id=0):
+    return f'circle:{circle_id}:tl:{tl_id or 0}'
+
+
+def user_scope(user_id):
+    return f'user:{user_id}'
+
+
+def scopes_for_post(post):
+    """投稿が表示されるフィードの scope 一覧"""
+    scopes = [user_scope(post.user_id)]
+    if post.circle_id:
+        scopes.append(circle_scope(post.circle_id, post.private_tl_id))
+    if post.is_public:
+        scopes.append(PUBLIC_SCOPE)
+    return scopes
+
+
+def _redis_key(scope):
+    return f'feed_cache:version:{scope}'
+
+
+def get_version(scope):
+    redis_client = get_redis()
+    if redis_client is not None:
+        return int(redis_client.get(_redis_key(scope)) or 0)
+    with _lock:
+        return _versions.get(scope, 0)
+
+
+def bump(*scopes):
+    """scope のバージョンを上げ、既存のキャッシュエントリを無効にする (コミット後に呼ぶ)"""
+    redis_client = get_redis()
+    if redis_client is not None:
+        pipe = redis_client.pipeline()
+        for scope in scopes:
+            pipe.incr(_redis_key(scope))
+        pipe.execute()
+        return
+    with _lock:
+        for scope in scopes:
+            _versions[scope] = _versions.get(scope, 0) + 1
+
+
+def invalidate_post(post):
+    """投稿が表示される全フィードのキャッシュを無効にする"""
+    bump(*scopes_for_post(post))
+
+
+def get_or_compute(scope, key, compute):
+    """
+    (scope, key) のキャッシュを返す。なければ compute() の結果を保存して返す。
+    compute 中にバージョンが上がった場合、結果は古いバージョンで保存されるため次回以降は使われない
+    """
+    cache_key = (scope, get_version(scope), key)
+    value = _pages.get(cache_key)
+    if value is None:
+        value = compute()
+        _pages.set(cache_key, value)
+    return value
+
+
+def get_post_fragments(posts, build):
+    """
+    投稿ごとのシリアライズ結果を {post_id: dict} で返す。
+    キャッシュにない投稿だけをまとめて build(posts) (同じ順序のdictリストを返す関数) でシリアライズする。
+    返すdictはキャッシュと共有されるため、呼び出し側で変更しないこと
+    """
+    fragments = {}
+    missing = []
+    for post in posts:
+        fragment = _post_fragments.get((post.id, post.version))
+        if fragment is None:
+            missing.append(post)
+        else:
+            fragments[post.id] = fragment
+    if missing:
+        for post, fragment in zip(missing, build(missing)):
+            _post_fragments.set((post.id, post.version), fragment)
+            fragments[post.id] = fragment
+    return fragments
+
+
+def clear():
+    _pages.clear()
+    _post_fragments.clear()
+    with _lock:
+        _versions.clear()
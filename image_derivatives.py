@@ -0,0 +1,134 @@
+# image_derivatives.py
+"""
+アップロード画像の縮小版 (avatar / card / full × WebP / JPEG) の生成
+
+フィードのカードやアイコン枠に元サイズの写真を配信しないよう、アップロード後に決まったサイズの縮小版を作る。
+画像の縮小・エンコードはCPU負荷が高く GIL を長く保持するため、Webワーカーのスレッドではなく
+プロセスプール (IMAGE_DERIVATIVE_WORKERS) で行う。縮小版は元画像のハッシュ値ごとに保存するため、
+同じ画像が再度アップロードされた場合は作り直さない。
+
+完成したら呼び出し側から渡された apply で投稿・サークル・ユーザーの行に縮小版のURLを保存する
+(投稿の場合は同じルームへ post_updated を送る)。
+Pillow がインストールされていない場合は何もしない (元画像だけを配信する)。
+"""
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import threading
+import metrics
+import media_store
+import wire
+from blocking import run_blocking
+from models import MediaBlob
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow は縮小版を作る場合のみ必要
+    Image = None
+    ImageOps = None
+
+IMAGE_DERIVATIVE_WORKERS = int(os.environ.get('IMAGE_DERIVATIVE_WORKERS', 2))
+
+# サイズごとの (幅, 高さ, 正方形に切り抜くか)。切り抜かないサイズは縦横比を保ってこの枠に収める (拡大はしない)
+SIZES = {
+    'avatar': (128, 128, True),
+    'card': (720, 720, False),
+    'full': (1600, 1600, False),
+}
+# 形式ごとの (Pillow の形式名, 保存オプション)
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+# 縮小版を作る元画像の形式 (GIF アニメーション・SVG は対象外)
+SOURCE_CONTENT_TYPES = ('image/jpeg', 'image/png', 'image/webp')
+
+_lock = threading.Lock()
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            # スレッドやイベントループの状態を子プロセスに引き継がないよう spawn で起動する
+            # (子プロセスは起動スクリプトを __mp_main__ として読み込み直すため、app.py / server.py はバックグラウンドタスクの開始とモンキーパッチを親プロセスに限っている)
+            _executor = ProcessPoolExecutor(
+                max_workers=IMAGE_DERIVATIVE_WORKERS, mp_context=multiprocessing.get_context('spawn')
+            )
+        return _executor
+
+
+def _save(image, path, fmt):
+    pil_format, options = FORMATS[fmt]
+    if fmt == 'jpeg' and image.mode != 'RGB':
+        image = image.convert('RGB')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    image.save(tmp_path, pil_format, **options)
+    os.replace(tmp_path, path)
+
+
+def render_derivatives(sha256, sizes):
+    """
+    元画像 sha256 の縮小版を作り、{サイズ: {形式: URL}} を返す (プロセスプールで実行される)。
+    作成済みのファイルはそのまま使う
+    """
+    variants = {}
+    source = None
+    try:
+        for size in sizes:
+            width, height, crop = SIZES[size]
+            variants[size] = {}
+            for fmt in FORMATS:
+                name = f'{size}.{fmt}'
+                path = media_store.derivative_path(sha256, name)
+                if not os.path.exists(path):
+                    if source is None:
+                        source = ImageOps.exif_transpose(Image.open(media_store.blob_path(sha256)))
+                        if source.mode not in ('RGB', 'RGBA'):
+                            source = source.convert('RGBA' if 'A' in source.getbands() else 'RGB')
+                    if crop:
+                        resized = ImageOps.fit(source, (width, height), Image.LANCZOS)
+                    else:
+                        resized = source.copy()
+                        resized.thumbnail((width, height), Image.LANCZOS)
+                    _save(resized, path, fmt)
+                variants[size][fmt] = media_store.derivative_url(sha256, name)
+    finally:
+        if source is not None:
+            source.close()
+    return variants
+
+
+def _on_done(future, sha256, apply, args):
+    try:
+        variants = future.result()
+        metrics.incr('image_derivatives.rendered')
+        result = run_blocking(apply, *args, variants)
+        if result is not None:
+            room_name, payload = result
+            if room_name:
+                wire.emit('post_updated', payload, room_name)
+    except Exception as e:
+        metrics.incr('image_derivatives.errors')
+        print(f"Image derivatives failed for {sha256}: {e}")
+
+
+def schedule(url, sizes, apply, *args):
+    """
+    media_store に保存した画像 url の縮小版の作成を予約する (行のコミット後に呼ぶ)。
+    完成したら apply(*args, variants) を run_blocking 経由で呼ぶ。apply が (ルーム名, 送信内容) を返した場合は post_updated を送る。
+    対象外の形式・Pillow 未導入の場合は何もしない
+    """
+    if Image is None:
+        return
+    sha256 = media_store.sha256_from_url(url)
+    if sha256 is None:
+        return
+    blob = MediaBlob.query.get(sha256)
+    if blob is None or blob.content_type not in SOURCE_CONTENT_TYPES:
+        return
+    metrics.incr('image_derivatives.queued')
+    future = _get_executor().submit(render_derivatives, sha256, tuple(sizes))
+    future.add_done_callback(lambda done: _on_done(done, sha256, apply, args))
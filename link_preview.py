@@ -0,0 +1,324 @@
+# link_preview.py
+"""
+投稿本文のリンクプレビュー (タイトル・説明・サムネイル) の取得
+
+外部サイトの応答速度が投稿の保存・配信に影響しないよう、投稿はリンク情報なしで先に保存・配信し、
+メタデータの取得は上限つきのワーカープールで後から行う。
+取得できたら呼び出し側から渡された apply で投稿を更新し、同じルームへ post_updated を送る。
+
+取得結果は正規化したURLごとに link_preview テーブルへ保存し (失敗も短い期限で保存する)、
+同じURLの投稿では主キー1回の参照で済ませて再取得しない。テーブルの件数は LINK_PREVIEW_CACHE_MAX_ENTRIES までに抑える。
+"""
+import os
+import re
+import time
+import codecs
+import hashlib
+import threading
+from html.parser import HTMLParser
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode, urljoin
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import metrics
+import wire
+from blocking import run_blocking
+from db_utils import dialect_insert
+from extensions import db
+from models import LinkPreview
+
+# 同時に取得するリンクの数と、1リクエストのタイムアウト (秒)
+LINK_PREVIEW_WORKERS = int(os.environ.get('LINK_PREVIEW_WORKERS', 4))
+LINK_PREVIEW_TIMEOUT = 5
+# 1件のリンクで読み込むHTMLの上限バイト数 (<head> を読み終えればそこで打ち切る)
+LINK_PREVIEW_MAX_BYTES = int(os.environ.get('LINK_PREVIEW_MAX_BYTES', 256 * 1024))
+HTML_CONTENT_TYPES = ('text/html', 'application/xhtml+xml')
+# 取得結果の有効秒数 (成功時 / 失敗時) と、保持する件数の上限
+LINK_PREVIEW_CACHE_TTL = int(os.environ.get('LINK_PREVIEW_CACHE_TTL', 7 * 24 * 3600))
+LINK_PREVIEW_NEGATIVE_TTL = int(os.environ.get('LINK_PREVIEW_NEGATIVE_TTL', 3600))
+LINK_PREVIEW_CACHE_MAX_ENTRIES = int(os.environ.get('LINK_PREVIEW_CACHE_MAX_ENTRIES', 50000))
+# この件数を保存するごとに期限切れ・上限超過分を削除する
+EVICT_EVERY = 100
+
+URL_PATTERN = re.compile(r'https?://[^\s<>"]+|www\.[^\s<>"]+')
+YOUTUBE_URL_PATTERN = r"(https?://)?(www\.)?(youtube\.com|youtu\.be)/(watch\?v=|embed/|v/|shorts/)?([a-zA-Z0-9_-]{11})"
+# 正規化時に取り除くトラッキング用のクエリパラメーター
+TRACKING_PARAMS = ('fbclid', 'gclid', 'si')
+
+# 投稿の列 (String(255)) の長さ。タイトルは切り詰め、超えるサムネイルURLは保存しない
+MAX_COLUMN_LENGTH = 255
+
+_executor = ThreadPoolExecutor(max_workers=LINK_PREVIEW_WORKERS, thread_name_prefix='link-preview')
+_lock = threading.Lock()
+# 取得中のURL (url_hash → 取得完了を待つ [(post_id, link_url, apply)])。同じURLを同時に何度も取得しない
+_inflight = {}
+_stores_since_evict = 0
+
+
+def find_first_url(content):
+    """本文中の最初のURL (なければ None)"""
+    match = URL_PATTERN.search(content or '')
+    return match.group(0) if match else None
+
+
+def normalize_url(link_url):
+    """
+    キャッシュキー用にURLを正規化する。
+    スキームとホストを小文字にし、フラグメント・既定ポート・トラッキング用パラメーターを除いてクエリを並べ替える。
+    YouTube の動画URLは形式 (youtu.be / shorts / embed) によらず watch?v= の形にそろえる
+    """
+    if link_url.startswith('www.'):
+        link_url = 'https://' + link_url
+    youtube = re.match(YOUTUBE_URL_PATTERN, link_url)
+    if youtube:
+        return f'https://www.youtube.com/watch?v={youtube.group(5)}'
+
+    parts = urlsplit(link_url)
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or '').lower()
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    if port and (scheme, port) not in (('http', 80), ('https', 443)):
+        netloc = f'{netloc}:{port}'
+    query = urlencode(sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not key.startswith('utm_') and key not in TRACKING_PARAMS
+    ))
+    return urlunsplit((scheme, netloc, parts.path or '/', query, ''))
+
+
+def url_hash(normalized_url):
+    return hashlib.sha256(normalized_url.encode('utf-8')).hexdigest()
+
+
+def _fit_columns(metadata):
+    """
+    取得結果を投稿の列 (String(255)) に合わせる。タイトルは切り詰め、
+    長すぎるサムネイルURLは切ると壊れたリンクになるため捨てる
+    """
+    title = metadata.get('title')
+    thumbnail_url = metadata.get('thumbnail_url')
+    if isinstance(title, str):
+        title = title[:MAX_COLUMN_LENGTH]
+    if thumbnail_url and len(thumbnail_url) > MAX_COLUMN_LENGTH:
+        metrics.incr('link_preview.thumbnail_too_long')
+        thumbnail_url = None
+    return {**metadata, 'title': title, 'thumbnail_url': thumbnail_url}
+
+
+def lookup(link_url):
+    """
+    キャッシュ済みの取得結果を返す (主キー1回の参照)。期限切れ・未取得なら None。
+    取得に失敗したURLは is_failure が True の行を返す
+    """
+    preview = LinkPreview.query.get(url_hash(normalize_url(link_url)))
+    if preview is None or preview.expires_at <= datetime.utcnow():
+        metrics.incr('link_preview.cache_miss')
+        return None
+    metrics.incr('link_preview.cache_hit')
+    return preview
+
+
+def preview_fields(preview):
+    """キャッシュ行から Post のリンク列の値 (link_url 以外) を作る"""
+    return {'title': preview.title, 'description': preview.description, 'thumbnail_url': preview.thumbnail_url}
+
+
+def _store(normalized_url, metadata):
+    """取得結果 (失敗時は metadata=None) をキャッシュに保存する (run_blocking 経由で呼ぶ)"""
+    global _stores_since_evict
+    now = datetime.utcnow()
+    ttl = LINK_PREVIEW_CACHE_TTL if metadata is not None else LINK_PREVIEW_NEGATIVE_TTL
+    values = {
+        'url': normalized_url,
+        'title': (metadata or {}).get('title'),
+        'description': (metadata or {}).get('description'),
+        'thumbnail_url': (metadata or {}).get('thumbnail_url'),
+        'is_failure': metadata is None,
+        'fetched_at': now,
+        'expires_at': now + timedelta(seconds=ttl),
+    }
+    stmt = dialect_insert(LinkPreview).values(url_hash=url_hash(normalized_url), **values).on_conflict_do_update(
+        index_elements=['url_hash'], set_=values
+    )
+    db.session.execute(stmt)
+    db.session.commit()
+
+    with _lock:
+        _stores_since_evict += 1
+        evict = _stores_since_evict >= EVICT_EVERY
+        if evict:
+            _stores_since_evict = 0
+    if evict:
+        evict_expired()
+
+
+def evict_expired():
+    """期限切れの行を削除し、上限を超えた分は期限の近いものから削除する"""
+    now = datetime.utcnow()
+    removed = LinkPreview.query.filter(LinkPreview.expires_at <= now).delete(synchronize_session=False)
+    overflow = LinkPreview.query.count() - LINK_PREVIEW_CACHE_MAX_ENTRIES
+    if overflow > 0:
+        oldest = db.select(LinkPreview.url_hash).order_by(LinkPreview.expires_at.asc()).limit(overflow)
+        removed += LinkPreview.query.filter(LinkPreview.url_hash.in_(oldest)).delete(synchronize_session=False)
+    db.session.commit()
+    metrics.incr('link_preview.evicted', removed)
+
+
+class _HeadMetadataParser(HTMLParser):
+    """<head> の og:title / og:description / og:image と <title> を読み取る。<body> に入ったら done になる"""
+
+    OG_PROPERTIES = {'og:title': 'title', 'og:description': 'description', 'og:image': 'thumbnail_url'}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.og = {}
+        self.title = None
+        self.done = False
+        self._in_title = False
+        self._title_parts = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'meta':
+            attrs = dict(attrs)
+            key = self.OG_PROPERTIES.get((attrs.get('property') or '').lower())
+            if key and key not in self.og and attrs.get('content'):
+                self.og[key] = attrs['content'].strip()
+        elif tag == 'title' and self.title is None:
+            self._in_title = True
+        elif tag == 'body':
+            self.done = True
+
+    def handle_endtag(self, tag):
+        if tag == 'title' and self._in_title:
+            self._in_title = False
+            self.title = ''.join(self._title_parts).strip() or None
+        elif tag == 'head':
+            self.done = True
+
+    def handle_data(self, data):
+        if self._in_title:
+            self._title_parts.append(data)
+
+
+def _read_head(response, encoding):
+    """レスポンス本文を少しずつ読み、<head> の終わりか上限バイト数に達したら打ち切ってパース結果を返す"""
+    try:
+        decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    except LookupError:
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    parser = _HeadMetadataParser()
+    deadline = time.monotonic() + LINK_PREVIEW_TIMEOUT
+    received = 0
+    for chunk in response.iter_content(chunk_size=8192):
+        received += len(chunk)
+        parser.feed(decoder.decode(chunk))
+        if parser.done:
+            break
+        if received >= LINK_PREVIEW_MAX_BYTES or time.monotonic() > deadline:
+            metrics.incr('link_preview.truncated')
+            break
+    metrics.incr('link_preview.bytes_read', received)
+    return parser
+
+
+def fetch_metadata(link_url):
+    """リンク先のメタデータを {'title', 'description', 'thumbnail_url'} で返す。取得できなければ None"""
+    try:
+        if re.match(YOUTUBE_URL_PATTERN, link_url):
+            oembed_url = f'https://www.youtube.com/oembed?url={link_url}&format=json'
+            response = requests.get(oembed_url, timeout=LINK_PREVIEW_TIMEOUT)
+            response.raise_for_status()
+            oembed_data = response.json()
+            return {
+                'title': oembed_data.get('title'),
+                'description': oembed_data.get('author_name', 'YouTube Video'),
+                'thumbnail_url': oembed_data.get('thumbnail_url'),
+            }
+
+        # 本文は一度に読み込まず、HTML以外はヘッダーを見た時点で打ち切る
+        with requests.get(link_url, timeout=LINK_PREVIEW_TIMEOUT, stream=True,
+                          headers={'Accept': 'text/html,application/xhtml+xml'}) as response:
+            response.raise_for_status()
+            content_type_header = response.headers.get('Content-Type', '')
+            content_type = content_type_header.split(';', 1)[0].strip().lower()
+            if content_type not in HTML_CONTENT_TYPES:
+                metrics.incr('link_preview.skipped_content_type')
+                return None
+            # charset の指定がない場合、requests は ISO-8859-1 とみなすため UTF-8 で読む
+            encoding = response.encoding if 'charset=' in content_type_header.lower() else 'utf-8'
+            parser = _read_head(response, encoding or 'utf-8')
+            base_url = response.url
+
+        thumbnail_url = parser.og.get('thumbnail_url')
+        return {
+            'title': parser.og.get('title') or parser.title,
+            'description': parser.og.get('description'),
+            'thumbnail_url': urljoin(base_url, thumbnail_url) if thumbnail_url else None,
+        }
+    except requests.exceptions.RequestException as e:
+        print(f"Error fetching link metadata: {e}")
+    except Exception as e:
+        print(f"Error processing link metadata: {e}")
+    return None
+
+
+def _apply_to_post(post_id, link_url, apply, metadata):
+    result = run_blocking(apply, post_id, link_url, metadata)
+    if result is None:
+        # 取得中に投稿が削除された
+        metrics.incr('link_preview.dropped')
+        return
+    room_name, payload = result
+    metrics.incr('link_preview.applied')
+    if room_name:
+        wire.emit('post_updated', payload, room_name)
+
+
+def _run(normalized_url):
+    key = url_hash(normalized_url)
+    metadata = None
+    try:
+        metadata = fetch_metadata(normalized_url)
+        if metadata is None:
+            metrics.incr('link_preview.failed')
+        else:
+            metadata = _fit_columns(metadata)
+        run_blocking(_store, normalized_url, metadata)
+    except Exception as e:
+        metrics.incr('link_preview.errors')
+        print(f"Link preview cache update failed for {normalized_url}: {e}")
+    finally:
+        with _lock:
+            waiters = _inflight.pop(key, [])
+
+    if metadata is None:
+        return
+    for post_id, link_url, apply in waiters:
+        try:
+            _apply_to_post(post_id, link_url, apply, metadata)
+        except Exception as e:
+            metrics.incr('link_preview.errors')
+            print(f"Link preview failed for post {post_id}: {e}")
+
+
+def schedule(post_id, link_url, apply):
+    """
+    投稿 post_id のリンクプレビューの取得を予約する (lookup() で見つからなかった場合に、投稿のコミット後に呼ぶ)。
+    apply(post_id, link_url, metadata) は run_blocking 経由で呼ばれ、投稿を更新して
+    (ルーム名, post_updated の送信内容) を返す (投稿がなければ None)。
+    同じURLを取得中の場合は新たに取得せず、その結果を待つ
+    """
+    normalized_url = normalize_url(link_url)
+    key = url_hash(normalized_url)
+    with _lock:
+        waiters = _inflight.get(key)
+        if waiters is not None:
+            waiters.append((post_id, link_url, apply))
+            metrics.incr('link_preview.coalesced')
+            return
+        _inflight[key] = [(post_id, link_url, apply)]
+    metrics.incr('link_preview.queued')
+    _executor.submit(_run, normalized_url)
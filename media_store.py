@@ -0,0 +1,170 @@
+# media_store.py
+"""
+アップロードファイルのコンテンツアドレス型ストレージ
+
+ファイルはディスクへ書き込みながら SHA-256 を計算し、ハッシュ値をファイル名にして
+MEDIA_ROOT/<先頭2文字>/<次の2文字>/<ハッシュ値> に保存する。同じ内容のファイルは1つだけ保存され (重複排除)、
+クライアントのファイル名が同じでも別の内容を上書きすることはない。
+
+media_blob がハッシュ値ごとの実体 (サイズ・Content-Type)、media がアップロード1件ごとの記録 (URL・元のファイル名・アップロード者) で、
+配信URL /media/<ハッシュ値> の内容は変わらないため、ブラウザ・CDN に無期限でキャッシュさせる。
+Content-Type はクライアントの申告ではなくファイル先頭のバイト列から判定し、画像・動画以外
+(HTML・SVG など) は application/octet-stream の添付ファイルとして配信する (アプリのオリジンでスクリプトを実行させない)。
+画像の縮小版 (image_derivatives.py) は MEDIA_ROOT/derived/ 以下に元画像のハッシュ値ごとに保存し、/media/<ハッシュ値>/<名前> で配信する。
+"""
+import os
+import re
+import uuid
+import hashlib
+from datetime import datetime
+from flask import Blueprint, abort, send_file
+from werkzeug.utils import secure_filename
+from extensions import db
+from db_utils import insert_ignore
+from models import MediaBlob, Media
+
+MEDIA_ROOT = os.environ.get('MEDIA_ROOT') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'media')
+# 書き込み時に一度に読むバイト数
+CHUNK_SIZE = 64 * 1024
+# 配信時のキャッシュ秒数 (内容が変わらないので1年)
+MEDIA_MAX_AGE = 365 * 24 * 3600
+
+SHA256_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+MEDIA_URL_PATTERN = re.compile(r'^/media/([0-9a-f]{64})$')
+# 縮小版のファイル名 (<サイズ>.<形式>) と Content-Type
+DERIVATIVE_PATTERN = re.compile(r'^[a-z]+\.(webp|jpeg)$')
+DERIVATIVE_CONTENT_TYPES = {'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+# そのまま (inline で) 配信する Content-Type。これ以外は添付ファイルとして配信する
+INLINE_CONTENT_TYPES = (
+    'image/jpeg', 'image/png', 'image/gif', 'image/webp',
+    'video/mp4', 'video/quicktime', 'video/webm',
+)
+DEFAULT_CONTENT_TYPE = 'application/octet-stream'
+
+media_bp = Blueprint('media', __name__)
+
+
+def blob_path(sha256):
+    """ハッシュ値の実体のパス (2階層のサブディレクトリに分散する)"""
+    return os.path.join(MEDIA_ROOT, sha256[:2], sha256[2:4], sha256)
+
+
+def media_url(sha256):
+    return f'/media/{sha256}'
+
+
+def sha256_from_url(url):
+    """save_upload() が返したURLのハッシュ値 (このストレージのURLでなければ None)"""
+    match = MEDIA_URL_PATTERN.match(url or '')
+    return match.group(1) if match else None
+
+
+def derivative_path(sha256, name):
+    """元画像 sha256 の縮小版 name (例: card.webp) のパス"""
+    return os.path.join(MEDIA_ROOT, 'derived', sha256[:2], sha256[2:4], sha256, name)
+
+
+def derivative_url(sha256, name):
+    return f'/media/{sha256}/{name}'
+
+
+def sniff_content_type(head):
+    """ファイル先頭のバイト列から INLINE_CONTENT_TYPES のいずれかを判定する (該当しなければ DEFAULT_CONTENT_TYPE)"""
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if head.startswith((b'GIF87a', b'GIF89a')):
+        return 'image/gif'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    if head[4:8] == b'ftyp':
+        return 'video/quicktime' if head[8:12] == b'qt  ' else 'video/mp4'
+    if head.startswith(b'\x1a\x45\xdf\xa3'):
+        return 'video/webm'
+    return DEFAULT_CONTENT_TYPE
+
+
+def _write_stream(stream):
+    """stream を一時ファイルへ書き込みながらハッシュ値を計算し、(一時ファイルのパス, ハッシュ値, サイズ, 先頭のバイト列) を返す"""
+    tmp_dir = os.path.join(MEDIA_ROOT, 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    tmp_path = os.path.join(tmp_dir, uuid.uuid4().hex)
+    digest = hashlib.sha256()
+    size = 0
+    head = b''
+    try:
+        with open(tmp_path, 'wb') as out:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                if not head:
+                    head = chunk[:16]
+                digest.update(chunk)
+                size += len(chunk)
+                out.write(chunk)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return tmp_path, digest.hexdigest(), size, head
+
+
+def save_upload(file, kind, uploader_id):
+    """
+    アップロードされたファイル (werkzeug の FileStorage) を保存し、配信URLを返す。
+    media / media_blob の行は呼び出し側のトランザクションに追加する (コミットは呼び出し側)
+    """
+    tmp_path, sha256, size, head = _write_stream(file.stream)
+    final_path = blob_path(sha256)
+    if os.path.exists(final_path):
+        # 同じ内容のファイルが保存済み
+        os.remove(tmp_path)
+    else:
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        os.replace(tmp_path, final_path)
+
+    filename = secure_filename(file.filename or '')
+    content_type = sniff_content_type(head)
+    now = datetime.utcnow()
+    insert_ignore(MediaBlob, sha256=sha256, size=size, content_type=content_type, created_at=now)
+    url = media_url(sha256)
+    db.session.add(Media(
+        url=url, blob_sha256=sha256, kind=kind, original_filename=filename,
+        uploader_id=uploader_id, created_at=now
+    ))
+    return url
+
+
+@media_bp.route('/media/<string:sha256>')
+def serve_media(sha256):
+    if not SHA256_PATTERN.match(sha256):
+        abort(404)
+    blob = MediaBlob.query.get(sha256)
+    path = blob_path(sha256)
+    if blob is None or not os.path.exists(path):
+        abort(404)
+    # 判定前に保存された実体もあるため、配信時にも対象の形式か確認する
+    content_type = blob.content_type if blob.content_type in INLINE_CONTENT_TYPES else DEFAULT_CONTENT_TYPE
+    return _send_immutable(path, content_type, sha256)
+
+
+@media_bp.route('/media/<string:sha256>/<string:name>')
+def serve_derivative(sha256, name):
+    match = DERIVATIVE_PATTERN.match(name)
+    if not SHA256_PATTERN.match(sha256) or not match:
+        abort(404)
+    path = derivative_path(sha256, name)
+    if not os.path.exists(path):
+        abort(404)
+    return _send_immutable(path, DERIVATIVE_CONTENT_TYPES[match.group(1)], f'{sha256}-{name}')
+
+
+def _send_immutable(path, content_type, etag):
+    response = send_file(path, mimetype=content_type, conditional=True, etag=etag, max_age=MEDIA_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    if content_type not in INLINE_CONTENT_TYPES:
+        response.headers['Content-Disposition'] = 'attachment'
+    return response
@@ -0,0 +1,23 @@
+# metrics.py
+"""
+プロセス内の簡易カウンター
+
+各モジュールから incr() で加算し、管理者用のメトリクスAPI (/admin/metrics) で snapshot() を返す。
+値はワーカープロセスごとに集計される。
+"""
+import threading
+from collections import Counter
+
+_lock = threading.Lock()
+_counters = Counter()
+
+
+def incr(name, value=1):
+    with _lock:
+        _counters[name] += value
+
+
+def snapshot():
+    """現在のカウンターを {名前: 値} で返す"""
+    with _lock:
+        return dict(sorted(_counters.items()))
@@ -23,10 +23,11 @@ class User(UserMixin, db.Model):
     university_id = db.Column(db.Integer, db.ForeignKey('course_university_mapping.id'), nullable=True)
     is_admin = db.Column(db.Boolean, default=False, nullable=False)
     timezone = db.Column(db.String(64), default='Asia/Tokyo', nullable=False)
-    following_ids = db.Column(JSON, default=list)
-    follower_ids = db.Column(JSON, default=list)
+    followers_count = db.Column(db.Integer, default=0, nullable=False, index=True)
     bio = db.Column(db.Text)
     profile_picture_url = db.Column(db.String(256))
+    # プロフィール画像の縮小版 {サイズ: {形式: URL}} (image_derivatives.py)
+    profile_picture_variants = db.Column(JSON, nullable=True)
     google_creds_json = db.Column(db.Text)
     reset_token = db.Column(db.String(64), unique=True)
     reset_token_expiration = db.Column(db.DateTime)
@@ -176,18 +177,24 @@ class Post(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     content = db.Column(db.Text, nullable=False)
     is_public = db.Column(db.Boolean, default=True)
-    likes = db.Column(JSON, default=list)
-    likes_count = db.Column(db.Integer, default=0)
+    likes_count = db.Column(db.Integer, default=0)  # post_like の件数 (いいね時に同じトランザクションで更新)
     comments_count = db.Column(db.Integer, default=0)
+    # いいね・コメント・リアクションなどで表示内容が変わるたびに加算する (シリアライズ結果のキャッシュキー)
+    version = db.Column(db.Integer, default=0, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     media_url = db.Column(db.String(256), nullable=True)
     media_type = db.Column(db.String(50), nullable=True)
+    # 添付画像の縮小版 {サイズ: {形式: URL}} (image_derivatives.py)
+    media_variants = db.Column(JSON, nullable=True)
     channel_id = db.Column(db.Integer, db.ForeignKey('channel.id'), nullable=True)
     
     # サークル投稿機能の外部キー (修正/追加)
     circle_id = db.Column(db.Integer, db.ForeignKey('circle.id'), nullable=True)
     private_tl_id = db.Column(db.Integer, db.ForeignKey('private_tl.id'), nullable=True)
     
+    # 関連授業
+    course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=True)
+    
     # 新しく追加されたリンクプレビュー用のカラム
     link_url = db.Column(db.String(255))
     link_title = db.Column(db.String(255))
@@ -201,6 +208,14 @@ class Post(db.Model):
     channel = relationship('Channel', back_populates='posts')
     circle = relationship('Circle', backref='posts')
     private_tl = relationship('PrivateTL', backref='posts')
+    course = relationship('Course', backref='posts')
+
+    # フィードのキーセットページング (created_at, id) 用の複合インデックス
+    __table_args__ = (
+        db.Index('ix_post_public_created', 'is_public', 'created_at', 'id'),
+        db.Index('ix_post_circle_tl_created', 'circle_id', 'private_tl_id', 'created_at', 'id'),
+        db.Index('ix_post_user_created', 'user_id', 'created_at', 'id'),
+    )
 
 class Comment(db.Model):
     __tablename__ = 'comment'
@@ -215,6 +230,11 @@ class Comment(db.Model):
     post = relationship('Post', back_populates='comments')
     user = relationship('User', back_populates='comments')
 
+    # 投稿ごとのコメントのプレビュー・ページング用
+    __table_args__ = (
+        db.Index('ix_comment_post_created', 'post_id', 'created_at', 'id'),
+    )
+
 # サークル機能の新しいモデル
 class Circle(db.Model):
     __tablename__ = 'circle'
@@ -229,6 +249,7 @@ class Circle(db.Model):
     
     # ****************** 修正/追加された部分 ******************
     background_image_url = db.Column(db.String(256), nullable=True) # 背景画像URL
+    background_image_variants = db.Column(JSON, nullable=True) # 背景画像の縮小版 {サイズ: {形式: URL}}
     executives_titles = db.Column(JSON, default=dict) # 幹部IDと役職名 (例: {"1": "広報部長"})
     # *********************************************************
     
@@ -281,17 +302,42 @@ class Reaction(db.Model):
     __table_args__ = (UniqueConstraint('post_id', 'user_id', 'emoji', name='_post_user_emoji_uc'),
                       UniqueConstraint('comment_id', 'user_id', 'emoji', name='_comment_user_emoji_uc'))
 
+# 投稿へのいいね (旧 Post.likes JSON配列を置き換え)
+class PostLike(db.Model):
+    __tablename__ = 'post_like'
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_post_like_user_post', 'user_id', 'post_id'),
+    )
+
+# 投稿ごとのリアクション数の集計 (リアクション書き込み時に同じトランザクションで更新する)
+class PostReactionCount(db.Model):
+    __tablename__ = 'post_reaction_count'
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), primary_key=True)
+    emoji = db.Column(db.String(50), primary_key=True)
+    count = db.Column(db.Integer, default=0, nullable=False)
+
 # DM機能の新しいモデル
 class DirectMessageConversation(db.Model):
     __tablename__ = 'direct_message_conversation'
     id = db.Column(db.Integer, primary_key=True)
+    # 参加者は常に user1_id < user2_id (小さいID, 大きいID) の順で保存する (dm.conversation_pair)
     user1_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     user2_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    # 受信箱の並び順・表示用に、最新メッセージをメッセージ保存と同じトランザクションで更新する
+    last_message_id = db.Column(db.Integer, db.ForeignKey('direct_message.id', use_alter=True), nullable=True)
+    last_message_at = db.Column(db.DateTime, nullable=True)
 
-    messages = relationship('DirectMessage', backref='conversation', lazy='dynamic')
+    messages = relationship('DirectMessage', backref='conversation', lazy='dynamic', foreign_keys='DirectMessage.conversation_id')
 
     __table_args__ = (
         UniqueConstraint('user1_id', 'user2_id', name='_user_pair_uc'),
+        # 受信箱 (参加者ごとに最終更新の新しい順) 用
+        db.Index('ix_dm_conv_user1_last', 'user1_id', 'last_message_at', 'id'),
+        db.Index('ix_dm_conv_user2_last', 'user2_id', 'last_message_at', 'id'),
     )
 
 class DirectMessage(db.Model):
@@ -302,6 +348,17 @@ class DirectMessage(db.Model):
     recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     content = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    is_read = db.Column(db.Boolean, default=False, nullable=False)
+    # 送信時にサーバーが振るID (ライトビハインド時の配信・重複保存の防止用。既存のメッセージは NULL)
+    message_uid = db.Column(db.String(32), nullable=True)
+
+    __table_args__ = (
+        # 未読数の集計用
+        db.Index('ix_dm_recipient_unread', 'recipient_id', 'is_read', 'conversation_id'),
+        # チャット履歴のページング用
+        db.Index('ix_dm_conversation_timestamp', 'conversation_id', 'timestamp', 'id'),
+        db.Index('ix_dm_message_uid', 'message_uid', unique=True),
+    )
 
 class Follow(db.Model):
     __tablename__ = 'follow'
@@ -312,9 +369,69 @@ class Follow(db.Model):
     follower = relationship('User', foreign_keys=[follower_id], backref=db.backref('following', lazy='dynamic'))
     followed = relationship('User', foreign_keys=[followed_id], backref=db.backref('followers', lazy='dynamic'))
 
+    # 主キー (follower_id, followed_id) に加え、フォロワー一覧の取得用
+    __table_args__ = (
+        db.Index('ix_follow_followed_follower', 'followed_id', 'follower_id'),
+    )
+
     def __repr__(self):
         return f'<Follow {self.follower_id} -> {self.followed_id}>'
 
+class LinkPreview(db.Model):
+    """リンクプレビューのキャッシュ (正規化したURLのSHA-256をキーにする。link_preview.py)"""
+    __tablename__ = 'link_preview'
+    url_hash = db.Column(db.String(64), primary_key=True)
+    url = db.Column(db.Text, nullable=False)
+    title = db.Column(db.String(255))
+    description = db.Column(db.Text)
+    thumbnail_url = db.Column(db.String(255))
+    # 取得に失敗したURL (期限まで再取得しない)
+    is_failure = db.Column(db.Boolean, default=False, nullable=False)
+    fetched_at = db.Column(db.DateTime, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    # 期限切れ・上限超過分の削除用
+    __table_args__ = (
+        db.Index('ix_link_preview_expires_at', 'expires_at'),
+    )
+
+class MediaBlob(db.Model):
+    """アップロードファイルの実体 (内容の SHA-256 ごとに1件。media_store.py)"""
+    __tablename__ = 'media_blob'
+    sha256 = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.Integer, nullable=False)
+    content_type = db.Column(db.String(255), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+class Media(db.Model):
+    """アップロード1件の記録 (配信URL → 実体)"""
+    __tablename__ = 'media'
+    id = db.Column(db.Integer, primary_key=True)
+    url = db.Column(db.String(256), nullable=False, index=True)
+    blob_sha256 = db.Column(db.String(64), db.ForeignKey('media_blob.sha256'), nullable=False)
+    # アップロード先の種類 (posts / circles / profile_pictures)
+    kind = db.Column(db.String(50), nullable=False)
+    original_filename = db.Column(db.String(255))
+    uploader_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    blob = relationship('MediaBlob')
+
+# フォロー中フィードのマテリアライズドタイムライン (fan-out-on-write)
+class TimelineEntry(db.Model):
+    __tablename__ = 'timeline_entry'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), primary_key=True)
+    author_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    post = relationship('Post')
+
+    __table_args__ = (
+        db.Index('ix_timeline_user_created', 'user_id', 'created_at', 'post_id'),
+        db.Index('ix_timeline_user_author', 'user_id', 'author_id'),
+    )
+
 class Event(db.Model):
     __tablename__ = 'event'
     id = db.Column(db.Integer, primary_key=True)
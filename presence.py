@@ -0,0 +1,246 @@
+# presence.py
+"""
+Socket.IO の接続・ルーム参加の登録簿 (プレゼンス)
+
+接続 (sid) ごとのユーザーと参加ルーム、ユーザーごと・ルームごとの接続を辞書と集合で保持し、
+オンライン判定や「ルームに誰かいるか」を O(1) で調べられるようにする。
+誰もいないルームへの送信はシリアライズごと省略できる。
+
+compact 形式 (wire.py) を要求した接続は、ルーム名に COMPACT_ROOM_SUFFIX を付けた別ルームへ参加させる。
+呼び出し側は常に元のルーム名で扱い、実際のルームとの対応はここで行う。
+
+REDIS_URL が設定されている場合はルーム・ユーザーごとの接続を Redis の集合にも登録し、
+他のワーカーに接続しているユーザーも判定に含める。
+Redis の集合はワーカーごとに分け (presence:<ワーカーID>:room:<ルーム名> など)、期限 PRESENCE_TTL 秒を付けて
+ハートビートで延長する。disconnect を処理できずに落ちたワーカーの登録は期限切れで消え、
+生存中のワーカー (presence:workers に最近ハートビートを記録したもの) の集合だけを判定に使う。
+"""
+import os
+import time
+import uuid
+import threading
+from flask import request
+from flask_login import current_user
+from flask_socketio import join_room, leave_room
+from shared_store import get_redis
+import wire
+
+# compact 形式の接続が参加するルームの接尾辞
+COMPACT_ROOM_SUFFIX = '~c'
+# Redis に登録した接続の有効秒数 (ハートビートはこの1/3の間隔で延長する)
+PRESENCE_TTL = int(os.environ.get('PRESENCE_TTL', 30))
+PRESENCE_HEARTBEAT_INTERVAL = max(1, PRESENCE_TTL // 3)
+# このワーカープロセスのID (Redis の登録をワーカーごとに分ける)
+WORKER_ID = uuid.uuid4().hex
+_WORKERS_KEY = 'presence:workers'
+
+_lock = threading.Lock()
+# sid -> {'user_id': ユーザーID, 'compact': compact形式か, 'rooms': 参加ルーム (元のルーム名) の集合}
+_sockets = {}
+# ユーザーID -> sid の集合
+_user_sockets = {}
+# 実際のルーム名 -> sid の集合
+_room_sockets = {}
+# 生存中の他のワーカーのID (ハートビートごとに更新する)
+_live_workers = []
+_heartbeat_started = False
+
+
+def user_room(user_id):
+    return f'user_{user_id}'
+
+
+def compact_room(room):
+    return f'{room}{COMPACT_ROOM_SUFFIX}'
+
+
+def _redis_room_key(room, worker_id=WORKER_ID):
+    return f'presence:{worker_id}:room:{room}'
+
+
+def _redis_user_key(user_id, worker_id=WORKER_ID):
+    return f'presence:{worker_id}:user:{user_id}'
+
+
+def _redis_add(key, sid):
+    redis_client = get_redis()
+    if redis_client is not None:
+        pipe = redis_client.pipeline()
+        pipe.sadd(key, sid)
+        pipe.expire(key, PRESENCE_TTL)
+        pipe.execute()
+
+
+def _heartbeat():
+    """このワーカーの登録の期限を延長し、生存中の他のワーカーの一覧を更新する"""
+    global _live_workers
+    redis_client = get_redis()
+    if redis_client is None:
+        return
+    now = time.time()
+    with _lock:
+        keys = [_redis_room_key(room) for room in _room_sockets]
+        keys += [_redis_user_key(user_id) for user_id in _user_sockets]
+    pipe = redis_client.pipeline()
+    pipe.zadd(_WORKERS_KEY, {WORKER_ID: now})
+    pipe.zremrangebyscore(_WORKERS_KEY, '-inf', now - PRESENCE_TTL)
+    for key in keys:
+        pipe.expire(key, PRESENCE_TTL)
+    pipe.zrangebyscore(_WORKERS_KEY, now - PRESENCE_TTL, '+inf')
+    workers = [worker_id.decode() if isinstance(worker_id, bytes) else worker_id for worker_id in pipe.execute()[-1]]
+    _live_workers = [worker_id for worker_id in workers if worker_id != WORKER_ID]
+
+
+def start_presence_heartbeat(socketio):
+    """REDIS_URL が設定されている場合に、ハートビートのバックグラウンドタスクを開始する (1プロセスにつき1回)"""
+    global _heartbeat_started
+    if get_redis() is None:
+        return
+    with _lock:
+        if _heartbeat_started:
+            return
+        _heartbeat_started = True
+
+    def worker():
+        while True:
+            try:
+                _heartbeat()
+            except Exception as e:
+                print(f"Presence heartbeat failed: {e}")
+            socketio.sleep(PRESENCE_HEARTBEAT_INTERVAL)
+
+    socketio.start_background_task(worker)
+
+
+def init_presence(sio_instance):
+    """接続・切断のハンドラを登録する (connect ハンドラはここだけで登録する)"""
+
+    @sio_instance.on('connect', namespace='/')
+    def handle_connect(auth=None):
+        if not current_user.is_authenticated:
+            print('Anonymous client attempted to connect.')
+            return False
+        register(request.sid, current_user.id, compact=wire.accepts_compact(auth))
+        join(request.sid, user_room(current_user.id))
+        print(f'Client {current_user.id} connected')
+
+    @sio_instance.on('disconnect', namespace='/')
+    def handle_disconnect():
+        unregister(request.sid)
+
+
+def register(sid, user_id, compact=False):
+    with _lock:
+        _sockets[sid] = {'user_id': user_id, 'compact': compact, 'rooms': set()}
+        _user_sockets.setdefault(user_id, set()).add(sid)
+    _redis_add(_redis_user_key(user_id), sid)
+
+
+def unregister(sid):
+    """切断された接続を、ユーザー・参加していた全ルームから取り除く"""
+    with _lock:
+        entry = _sockets.pop(sid, None)
+        if entry is None:
+            return
+        user_id = entry['user_id']
+        rooms = [_actual_room(entry, room) for room in entry['rooms']]
+        sids = _user_sockets.get(user_id)
+        if sids is not None:
+            sids.discard(sid)
+            if not sids:
+                del _user_sockets[user_id]
+        for room in rooms:
+            _discard_room_socket(room, sid)
+    redis_client = get_redis()
+    if redis_client is not None:
+        pipe = redis_client.pipeline()
+        pipe.srem(_redis_user_key(user_id), sid)
+        for room in rooms:
+            pipe.srem(_redis_room_key(room), sid)
+        pipe.execute()
+
+
+def _actual_room(entry, room):
+    return compact_room(room) if entry['compact'] else room
+
+
+def _discard_room_socket(room, sid):
+    sids = _room_sockets.get(room)
+    if sids is not None:
+        sids.discard(sid)
+        if not sids:
+            del _room_sockets[room]
+
+
+def join(sid, room):
+    """接続をルームに参加させる (権限チェックは呼び出し側で行う)"""
+    with _lock:
+        entry = _sockets.get(sid)
+        if entry is None:
+            return
+        actual_room = _actual_room(entry, room)
+        entry['rooms'].add(room)
+        _room_sockets.setdefault(actual_room, set()).add(sid)
+    join_room(actual_room, sid=sid, namespace='/')
+    _redis_add(_redis_room_key(actual_room), sid)
+
+
+def leave(sid, room):
+    with _lock:
+        entry = _sockets.get(sid)
+        if entry is None:
+            return
+        actual_room = _actual_room(entry, room)
+        entry['rooms'].discard(room)
+        _discard_room_socket(actual_room, sid)
+    leave_room(actual_room, sid=sid, namespace='/')
+    redis_client = get_redis()
+    if redis_client is not None:
+        redis_client.srem(_redis_room_key(actual_room), sid)
+
+
+def in_room(sid, room):
+    """接続 sid が room に参加しているか"""
+    entry = _sockets.get(sid)
+    return entry is not None and room in entry['rooms']
+
+
+def _has_sockets(actual_room):
+    if actual_room in _room_sockets:
+        return True
+    redis_client = get_redis()
+    workers = _live_workers
+    if redis_client is not None and workers:
+        return redis_client.exists(*[_redis_room_key(actual_room, worker_id) for worker_id in workers]) > 0
+    return False
+
+
+def listening_rooms(room):
+    """room に対応する実際のルームのうち、接続中のクライアントがいるものを [(ルーム名, compact形式か)] で返す"""
+    if not room:
+        return []
+    targets = [(room, False), (compact_room(room), True)]
+    return [(actual_room, compact) for actual_room, compact in targets if _has_sockets(actual_room)]
+
+
+def room_has_listeners(room):
+    """ルームに (どちらかの形式で) 接続中のクライアントがいるか"""
+    return bool(listening_rooms(room))
+
+
+def is_online(user_id):
+    return user_id in online_user_ids([user_id])
+
+
+def online_user_ids(user_ids):
+    """user_ids のうちオンライン (1つ以上接続がある) のユーザーIDの集合"""
+    online = {user_id for user_id in user_ids if user_id in _user_sockets}
+    redis_client = get_redis()
+    rest = [user_id for user_id in user_ids if user_id not in online]
+    workers = _live_workers
+    if redis_client is not None and rest and workers:
+        pipe = redis_client.pipeline()
+        for user_id in rest:
+            pipe.exists(*[_redis_user_key(user_id, worker_id) for worker_id in workers])
+        online.update(user_id for user_id, exists in zip(rest, pipe.execute()) if exists)
+    return online
@@ -0,0 +1,139 @@
+# ranking.py
+"""
+おすすめフィードのランキング
+
+直近の公開投稿を候補として、経過時間による減衰といいね数・コメント数・リアクション数から
+NumPy でまとめてスコアを計算し、順位付きの投稿IDリストを定期的に作り直す。
+リクエスト時は計算済みのリストを offset で切り出すだけで済む。
+"""
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import numpy as np
+from sqlalchemy import func
+from extensions import db
+from models import Post, PostReactionCount
+from blocking import run_blocking
+
+# 候補にする投稿の期間 (時間) と最大件数
+RANKING_WINDOW_HOURS = int(os.environ.get('RANKING_WINDOW_HOURS', 72))
+RANKING_CANDIDATE_LIMIT = int(os.environ.get('RANKING_CANDIDATE_LIMIT', 2000))
+# ランキングを作り直す間隔 (秒)
+RANKING_REFRESH_INTERVAL = int(os.environ.get('RANKING_REFRESH_INTERVAL', 60))
+# スコアが半分になるまでの時間 (時間)
+RANKING_HALF_LIFE_HOURS = 12.0
+# 各指標の重み (件数は log1p で圧縮してから掛ける)
+LIKE_WEIGHT = 1.0
+COMMENT_WEIGHT = 2.0
+REACTION_WEIGHT = 0.5
+# ページング中のランキングが作り直されても続きを読めるよう、直近いくつかの世代を保持する
+SNAPSHOT_HISTORY = 3
+
+EPOCH = datetime(1970, 1, 1)
+
+_lock = threading.Lock()
+_snapshots = OrderedDict()
+_worker_started = False
+
+
+def _epoch_seconds(value):
+    """created_at (UTC の naive datetime) を UNIX 秒に変換する"""
+    return (value - EPOCH).total_seconds()
+
+
+def _load_candidates():
+    """候補投稿の (id, created_at, likes_count, comments_count, リアクション合計) を新しい順で取得する"""
+    reaction_totals = db.session.query(
+        PostReactionCount.post_id.label('post_id'),
+        func.sum(PostReactionCount.count).label('total')
+    ).group_by(PostReactionCount.post_id).subquery()
+    since = datetime.utcnow() - timedelta(hours=RANKING_WINDOW_HOURS)
+    return db.session.query(
+        Post.id, Post.created_at, Post.likes_count, Post.comments_count,
+        func.coalesce(reaction_totals.c.total, 0)
+    ).outerjoin(reaction_totals, reaction_totals.c.post_id == Post.id).filter(
+        Post.is_public == True, Post.created_at >= since
+    ).order_by(Post.created_at.desc(), Post.id.desc()).limit(RANKING_CANDIDATE_LIMIT).all()
+
+
+def score_posts(ids, created_at, likes, comments, reactions, now=None):
+    """
+    各配列から投稿スコアを計算し、スコアの高い順に並べた投稿IDの配列を返す (同点は新しい投稿を優先)
+    """
+    now = now if now is not None else time.time()
+    age_hours = np.maximum(now - created_at, 0.0) / 3600.0
+    engagement = (
+        1.0
+        + LIKE_WEIGHT * np.log1p(likes)
+        + COMMENT_WEIGHT * np.log1p(comments)
+        + REACTION_WEIGHT * np.log1p(reactions)
+    )
+    scores = engagement * np.power(0.5, age_hours / RANKING_HALF_LIFE_HOURS)
+    order = np.lexsort((-ids, -scores))
+    return ids[order]
+
+
+def refresh():
+    """ランキングを作り直して新しい世代として保存する (アプリケーションコンテキスト内で呼ぶ)"""
+    rows = _load_candidates()
+    if rows:
+        columns = list(zip(*rows))
+        ids = np.array(columns[0], dtype=np.int64)
+        created_at = np.array([_epoch_seconds(value) for value in columns[1]], dtype=np.float64)
+        counts = [np.array([value or 0 for value in column], dtype=np.float64) for column in columns[2:]]
+        ranked_ids = tuple(score_posts(ids, created_at, *counts).tolist())
+        oldest = rows[-1]
+    else:
+        ranked_ids = ()
+        oldest = None
+
+    with _lock:
+        # 世代はプロセスごとの連番ではなくランダムなIDにする。再起動後や別ワーカーで古いカーソルの世代が
+        # 別のランキングに一致し、offset がずれて重複・抜けが出るのを防ぐ
+        generation = uuid.uuid4().hex[:16]
+        _snapshots[generation] = {
+            'generation': generation,
+            'post_ids': ranked_ids,
+            # 候補のうち最も古い投稿の行 (id, created_at)。ランキングを読み終えた後はこれより古い投稿を時系列で返す
+            'oldest': oldest,
+            'computed_at': time.time(),
+        }
+        while len(_snapshots) > SNAPSHOT_HISTORY:
+            _snapshots.popitem(last=False)
+        return _snapshots[generation]
+
+
+def get_snapshot(generation=None):
+    """
+    指定した世代 (省略時は最新) のランキングを返す。
+    指定した世代が破棄済みの場合は最新を返し、まだ一度も計算していない場合はその場で計算する
+    """
+    with _lock:
+        if generation in _snapshots:
+            return _snapshots[generation]
+        if _snapshots:
+            return _snapshots[next(reversed(_snapshots))]
+    return refresh()
+
+
+def start_ranking_worker(socketio):
+    """ランキングを定期的に作り直すバックグラウンドタスクを開始する (1プロセスにつき1回)"""
+    global _worker_started
+    with _lock:
+        if _worker_started:
+            return
+        _worker_started = True
+
+    def worker():
+        # 初回はリクエスト時に get_snapshot() が計算するので、ここでは間隔をおいてから作り直す
+        while True:
+            socketio.sleep(RANKING_REFRESH_INTERVAL)
+            try:
+                run_blocking(refresh)
+            except Exception as e:
+                print(f"Ranking refresh failed: {e}")
+
+    socketio.start_background_task(worker)
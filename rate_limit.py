@@ -0,0 +1,171 @@
+# rate_limit.py
+"""
+ユーザー・操作ごとのトークンバケットによる流量制限
+
+操作 (いいね・コメント・send_dm など) ごとに「バースト上限 / 補充にかかる秒数」を設定し、
+ユーザーごとのバケットからトークンを1つずつ消費する。トークンがなければ拒否し、再試行までの秒数を返す。
+不具合のあるクライアントのループなどで1人がDBを占有し、他の利用者の応答が遅くなるのを防ぐ。
+
+上限は環境変数 RATE_LIMIT_<操作名> (例: RATE_LIMIT_LIKE=60/60 は60回までのバースト、60秒で満タンに戻る) で変更できる。
+バケットは既定ではプロセスごとに持つ。RATE_LIMIT_SHARED=1 かつ REDIS_URL が設定されていれば Redis に置き、
+全ワーカーで共有する (Redis に接続できない場合はプロセス内のバケットで判定する)。
+"""
+import os
+import time
+import threading
+from collections import OrderedDict
+from functools import wraps
+from flask import jsonify, request
+from flask_login import current_user
+from flask_socketio import emit
+import metrics
+from shared_store import get_redis
+
+RATE_LIMIT_SHARED = os.environ.get('RATE_LIMIT_SHARED') == '1'
+# プロセス内で保持するバケット数の上限 (超えたら最も長く使われていないバケットから捨てる)
+RATE_LIMIT_MAX_BUCKETS = int(os.environ.get('RATE_LIMIT_MAX_BUCKETS', 100000))
+
+# 操作ごとの既定の上限 "バースト上限/満タンに戻るまでの秒数"
+DEFAULT_LIMITS = {
+    'send_dm': '30/30',
+    'create_post': '10/10',
+    'new_comment': '20/10',
+    'post': '10/60',
+    'comment': '20/60',
+    'like': '60/60',
+    'react': '60/60',
+    'follow': '30/60',
+}
+
+
+def _parse_limit(value):
+    """'容量/秒数' を (容量, 1秒あたりの補充数) に変換する"""
+    capacity, period = value.split('/', 1)
+    capacity = float(capacity)
+    return capacity, capacity / float(period)
+
+
+def _load_limits():
+    limits = {}
+    for action, default in DEFAULT_LIMITS.items():
+        value = os.environ.get(f'RATE_LIMIT_{action.upper()}', default)
+        try:
+            limits[action] = _parse_limit(value)
+        except (ValueError, ZeroDivisionError):
+            print(f"Invalid RATE_LIMIT_{action.upper()}={value!r}, using {default}")
+            limits[action] = _parse_limit(default)
+    return limits
+
+
+LIMITS = _load_limits()
+
+_lock = threading.Lock()
+# (ユーザーID, 操作) → [残りトークン, 最終更新時刻] (最近使われた順。末尾が最新)
+_buckets = OrderedDict()
+
+# Redis 上で補充・消費を原子的に行うスクリプト。{許可なら1, 再試行までの秒数} を返す
+_REDIS_TOKEN_BUCKET = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local retry_after = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    retry_after = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return {allowed, tostring(retry_after)}
+"""
+_redis_script = None
+
+
+def _take_local(key, capacity, rate):
+    now = time.monotonic()
+    with _lock:
+        bucket = _buckets.get(key)
+        if bucket is None:
+            while len(_buckets) >= RATE_LIMIT_MAX_BUCKETS:
+                _buckets.popitem(last=False)
+            bucket = _buckets[key] = [capacity, now]
+        else:
+            _buckets.move_to_end(key)
+        tokens = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            return True, 0.0
+        bucket[0] = tokens
+        return False, (1 - tokens) / rate
+
+
+def _take_shared(redis_client, key, capacity, rate):
+    global _redis_script
+    if _redis_script is None:
+        _redis_script = redis_client.register_script(_REDIS_TOKEN_BUCKET)
+    allowed, retry_after = _redis_script(keys=[f'rate_limit:{key[1]}:{key[0]}'], args=[capacity, rate])
+    return bool(int(allowed)), float(retry_after)
+
+
+def acquire(user_id, action):
+    """
+    user_id の action を1回分消費する。(許可されたか, 再試行までの秒数) を返す。
+    上限が設定されていない action は常に許可する
+    """
+    limit = LIMITS.get(action)
+    if limit is None:
+        return True, 0.0
+    capacity, rate = limit
+    key = (user_id, action)
+
+    redis_client = get_redis() if RATE_LIMIT_SHARED else None
+    if redis_client is not None:
+        try:
+            allowed, retry_after = _take_shared(redis_client, key, capacity, rate)
+        except Exception as e:
+            metrics.incr('rate_limit.shared_errors')
+            print(f"Rate limit shared store failed, falling back to local buckets: {e}")
+            allowed, retry_after = _take_local(key, capacity, rate)
+    else:
+        allowed, retry_after = _take_local(key, capacity, rate)
+
+    if not allowed:
+        metrics.incr('rate_limit.rejected')
+        metrics.incr(f'rate_limit.{action}.rejected')
+    return allowed, retry_after
+
+
+def allow_socket_event(action):
+    """Socket.IO のイベントハンドラ用。上限を超えた場合は送信元に rate_limited を送って False を返す"""
+    allowed, retry_after = acquire(current_user.id, action)
+    if not allowed:
+        emit('rate_limited', {'event': action, 'retry_after': retry_after})
+    return allowed
+
+
+def rate_limited(action, methods=('POST', 'PUT', 'PATCH', 'DELETE')):
+    """
+    ログイン中のユーザーごとに action の流量を制限するルート用デコレーター (login_required の後に付ける)。
+    methods 以外 (GET など) のリクエストは制限しない。上限を超えた場合は 429 と Retry-After を返す
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method in methods and current_user.is_authenticated:
+                allowed, retry_after = acquire(current_user.id, action)
+                if not allowed:
+                    response = jsonify({"error": "操作が多すぎます。しばらく待ってから再度お試しください。", "retry_after": retry_after})
+                    response.status_code = 429
+                    response.headers['Retry-After'] = str(max(1, int(retry_after + 0.999)))
+                    return response
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,90 @@
+# realtime.py
+"""
+いいね・リアクションなどのリアルタイム更新の集約 (coalescing)
+
+人気の投稿ではクリックのたびにルーム全体へ emit すると送信数がクリック数に比例して増えるため、
+(イベント, ルーム, 対象ID) ごとに短い時間窓の間の更新を1回にまとめ、窓の終わりに最新の値だけを送る。
+送信内容は送信時にDBからまとめて読み込むので、まとめられた更新のうちどれが最後にコミットされたかに依存しない。
+"""
+import os
+import threading
+import metrics
+import presence
+import wire
+from blocking import run_blocking
+
+# 更新をまとめる時間窓 (ミリ秒)
+REALTIME_COALESCE_WINDOW_MS = int(os.environ.get('REALTIME_COALESCE_WINDOW_MS', 250))
+
+_lock = threading.Lock()
+_pending = set()
+_flush_scheduled = False
+_builders = {}
+_socketio = None
+
+
+def init_realtime(sio_instance):
+    global _socketio
+    _socketio = sio_instance
+
+
+def register_builder(event, build):
+    """
+    event の送信内容を作る関数を登録する。
+    build(keys) は対象IDの集合を受け取り {対象ID: 送信するdict} を返す (存在しない対象は含めない)
+    """
+    _builders[event] = build
+
+
+def queue_update(event, room, key):
+    """room への event (対象 key) の送信を予約する。時間窓内の同じ更新は1回にまとめる"""
+    global _flush_scheduled
+    if not presence.room_has_listeners(room):
+        metrics.incr(f'realtime.{event}.skipped')
+        return
+    with _lock:
+        if (event, room, key) in _pending:
+            metrics.incr(f'realtime.{event}.merged')
+            return
+        _pending.add((event, room, key))
+        metrics.incr(f'realtime.{event}.queued')
+        if _flush_scheduled:
+            return
+        _flush_scheduled = True
+    _socketio.start_background_task(_flush_later)
+
+
+def _flush_later():
+    global _flush_scheduled
+    _socketio.sleep(REALTIME_COALESCE_WINDOW_MS / 1000.0)
+    with _lock:
+        pending = list(_pending)
+        _pending.clear()
+        _flush_scheduled = False
+    try:
+        flush(pending)
+    except Exception as e:
+        metrics.incr('realtime.flush_errors')
+        print(f"Realtime flush failed: {e}")
+
+
+def _build_payloads(keys_by_event):
+    return {event: _builders[event](keys) for event, keys in keys_by_event.items()}
+
+
+def flush(pending):
+    """予約された更新をイベントごとにまとめて読み込み、各ルームへ送信する"""
+    keys_by_event = {}
+    for event, room, key in pending:
+        keys_by_event.setdefault(event, set()).add(key)
+    payloads = run_blocking(_build_payloads, keys_by_event)
+
+    metrics.incr('realtime.flushes')
+    for event, room, key in pending:
+        payload = payloads[event].get(key)
+        if payload is None:
+            # 送信までに対象が削除された
+            metrics.incr(f'realtime.{event}.dropped')
+            continue
+        wire.emit(event, payload, room)
+        metrics.incr(f'realtime.{event}.emitted')
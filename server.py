@@ -0,0 +1,26 @@
+# server.py
+"""
+非同期ワーカーモードで起動するためのエントリポイント
+
+SOCKETIO_ASYNC_MODE=eventlet / gevent の場合、他のモジュール (app.py など) を読み込む前に
+標準ライブラリをモンキーパッチする。
+    SOCKETIO_ASYNC_MODE=eventlet python server.py
+    SOCKETIO_ASYNC_MODE=eventlet gunicorn -k eventlet -w 1 server:app
+"""
+import os
+import multiprocessing
+
+ASYNC_MODE = os.environ.get('SOCKETIO_ASYNC_MODE')
+# 画像の縮小版を作るプロセスプール (spawn) の子プロセスもこのスクリプトを読み込み直すが、そこではパッチしない
+if multiprocessing.parent_process() is None:
+    if ASYNC_MODE == 'eventlet':
+        import eventlet
+        eventlet.monkey_patch()
+    elif ASYNC_MODE == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+
+from app import app, socketio
+
+if __name__ == '__main__':
+    socketio.run(app, host=os.environ.get('HOST', '0.0.0.0'), port=int(os.environ.get('PORT', 5000)))
@@ -0,0 +1,28 @@
+# shared_store.py
+"""
+複数ワーカープロセスで共有する状態 (キャッシュのバージョンなど) のための Redis 接続
+
+REDIS_URL が未設定の場合は None を返し、各モジュールはプロセス内の状態だけで動作する (1プロセス構成)。
+redis パッケージは REDIS_URL を設定したときだけ必要になる。
+"""
+import os
+import threading
+
+REDIS_URL = os.environ.get('REDIS_URL')
+# Socket.IO のプロセス間メッセージキュー。未設定なら REDIS_URL を使う
+SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE') or REDIS_URL
+
+_lock = threading.Lock()
+_client = None
+
+
+def get_redis():
+    """共有の Redis クライアントを返す。REDIS_URL が未設定なら None"""
+    global _client
+    if not REDIS_URL:
+        return None
+    with _lock:
+        if _client is None:
+            import redis
+            _client = redis.Redis.from_url(REDIS_URL)
+        return _client
@@ -0,0 +1,137 @@
+# timeline.py
+"""
+フォロー中フィードのマテリアライズドタイムライン (fan-out-on-write)
+
+投稿時にフォロワーのタイムライン (timeline_entry) へ書き込んでおき、
+読み込み時は (user_id, created_at, post_id) のインデックスを辿るだけで済むようにする。
+フォロワーが非常に多いアカウントは書き込み時に展開せず、読み込み時にマージする (fan-out-on-read)。
+"""
+import os
+import time
+from extensions import db
+from models import Post, User, TimelineEntry, Follow
+
+# フォロワー数がこれを超えるアカウントは fan-out-on-write せず、読み込み時にマージする
+FANOUT_FOLLOWER_LIMIT = int(os.environ.get('TIMELINE_FANOUT_FOLLOWER_LIMIT', 5000))
+# フォロー開始時にタイムラインへ取り込む過去投稿数
+FOLLOW_BACKFILL_LIMIT = 50
+# 高フォロワーアカウント一覧のキャッシュ秒数
+HIGH_FANOUT_CACHE_TTL = 60
+
+_high_fanout_cache = {'ids': frozenset(), 'expires': 0}
+
+
+def is_high_fanout(user):
+    return (user.followers_count or 0) > FANOUT_FOLLOWER_LIMIT
+
+
+def high_fanout_user_ids():
+    """fan-out-on-read 対象のアカウントID一覧 (件数が少ないのでプロセス内でキャッシュする)"""
+    now = time.time()
+    if _high_fanout_cache['expires'] < now:
+        rows = db.session.query(User.id).filter(User.followers_count > FANOUT_FOLLOWER_LIMIT).all()
+        _high_fanout_cache['ids'] = frozenset(row.id for row in rows)
+        _high_fanout_cache['expires'] = now + HIGH_FANOUT_CACHE_TTL
+    return _high_fanout_cache['ids']
+
+
+def high_fanout_followee_ids(user):
+    """userがフォローしている高フォロワーアカウントのID"""
+    high_fanout_ids = high_fanout_user_ids()
+    if not high_fanout_ids:
+        return []
+    rows = db.session.query(Follow.followed_id).filter(
+        Follow.follower_id == user.id, Follow.followed_id.in_(high_fanout_ids)
+    ).all()
+    return [row.followed_id for row in rows]
+
+
+def follower_ids(user_id):
+    """user_idのフォロワーID一覧 (ix_follow_followed_follower を使う)"""
+    return [row.follower_id for row in db.session.query(Follow.follower_id).filter(Follow.followed_id == user_id)]
+
+
+def _fanout_post_query():
+    """タイムラインに展開する投稿 (公開投稿のみ)"""
+    return Post.query.filter(Post.is_public == True)
+
+
+def fan_out_post(post):
+    """
+    投稿を投稿者自身とフォロワーのタイムラインに書き込む。
+    呼び出し側のトランザクション内で実行し、コミットは呼び出し側で行う。
+    """
+    if not post.is_public:
+        return
+    author = post.user or User.query.get(post.user_id)
+    recipient_ids = {post.user_id}
+    if author and not is_high_fanout(author):
+        recipient_ids.update(follower_ids(post.user_id))
+
+    db.session.execute(TimelineEntry.__table__.insert(), [
+        {'user_id': user_id, 'post_id': post.id, 'author_id': post.user_id, 'created_at': post.created_at}
+        for user_id in recipient_ids
+    ])
+
+
+def remove_post(post_id):
+    """削除された投稿を全タイムラインから取り除く"""
+    TimelineEntry.query.filter_by(post_id=post_id).delete(synchronize_session=False)
+
+
+def on_follow(follower_id, followed_user):
+    """フォロー開始時に、フォロー先の最近の投稿をタイムラインへ取り込む"""
+    if is_high_fanout(followed_user):
+        return
+    recent_posts = _fanout_post_query().filter(Post.user_id == followed_user.id).order_by(
+        Post.created_at.desc(), Post.id.desc()
+    ).limit(FOLLOW_BACKFILL_LIMIT).all()
+    existing_ids = {
+        row.post_id for row in db.session.query(TimelineEntry.post_id).filter(
+            TimelineEntry.user_id == follower_id, TimelineEntry.author_id == followed_user.id
+        )
+    }
+    rows = [
+        {'user_id': follower_id, 'post_id': post.id, 'author_id': post.user_id, 'created_at': post.created_at}
+        for post in recent_posts if post.id not in existing_ids
+    ]
+    if rows:
+        db.session.execute(TimelineEntry.__table__.insert(), rows)
+
+
+def on_unfollow(follower_id, followed_id):
+    """フォロー解除時に、フォロー先の投稿をタイムラインから取り除く"""
+    TimelineEntry.query.filter_by(user_id=follower_id, author_id=followed_id).delete(synchronize_session=False)
+
+
+def timeline_query(user_id):
+    """userのマテリアライズドタイムラインの投稿クエリ"""
+    return Post.query.join(TimelineEntry, TimelineEntry.post_id == Post.id).filter(TimelineEntry.user_id == user_id)
+
+
+def high_fanout_posts_query(author_ids):
+    """fan-out-on-read 対象アカウントの投稿クエリ"""
+    return _fanout_post_query().filter(Post.user_id.in_(author_ids))
+
+
+def backfill_timelines(per_user_limit=200):
+    """
+    既存データからタイムラインを作成する (初回移行用)。
+    各ユーザーについて、自分とフォロー先の最近の公開投稿を取り込む。
+    """
+    high_fanout_ids = high_fanout_user_ids()
+    following = {}
+    for follow in db.session.query(Follow.follower_id, Follow.followed_id):
+        if follow.followed_id not in high_fanout_ids:
+            following.setdefault(follow.follower_id, set()).add(follow.followed_id)
+    for (user_id,) in db.session.query(User.id):
+        author_ids = {user_id} | following.get(user_id, set())
+        posts = _fanout_post_query().filter(Post.user_id.in_(author_ids)).order_by(
+            Post.created_at.desc(), Post.id.desc()
+        ).limit(per_user_limit).all()
+        if posts:
+            db.session.execute(TimelineEntry.__table__.insert(), [
+                {'user_id': user_id, 'post_id': post.id, 'author_id': post.user_id, 'created_at': post.created_at}
+                for post in posts
+            ])
+    db.session.commit()
@@ -0,0 +1,135 @@
+# wire.py
+"""
+リアルタイムイベントの送信形式
+
+既定では従来どおりJSON (dict) で送る。接続時に auth={'codec': 'msgpack'} を指定したクライアントには、
+キー名を短いIDに置き換え、日時を整形済み文字列の代わりにUNIX秒で表した MessagePack (バイナリ) で送る。
+クライアントごとに形式が異なるため、compact クライアントは presence がルーム名に接尾辞を付けた別ルームへ参加させ、
+emit() は各ルームに誰かいる場合だけその形式で送る。
+"""
+import os
+from datetime import datetime
+import presence
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+COMPACT_CODEC = 'msgpack'
+# false にすると compact 形式を無効にする (msgpack 未インストール時も無効)
+REALTIME_COMPACT_ENCODING = os.environ.get('REALTIME_COMPACT_ENCODING', 'true').lower() == 'true'
+
+# 長いキー名 -> 短いID (クライアントの復元用に base.html にも渡す)
+SHORT_KEYS = {
+    'id': 'i',
+    'post_id': 'pi',
+    'comment_id': 'ki',
+    'content': 'c',
+    'user_id': 'u',
+    'username': 'n',
+    'user_profile_picture': 'p',
+    'user_profile_picture_url': 'pu',
+    'likes_count': 'l',
+    'comments_count': 'cc',
+    'is_liked': 'il',
+    'media_url': 'mu',
+    'media_type': 'mt',
+    'reaction_counts': 'rc',
+    'channel_id': 'ch',
+    'circle_id': 'ci',
+    'tl_id': 'tl',
+    'link_url': 'lu',
+    'link_title': 'lt',
+    'link_description': 'ld',
+    'link_thumbnail_url': 'lm',
+    'comments': 'cm',
+    'comment': 'co',
+    'comments_cursor': 'cr',
+    'circle_name': 'cn',
+    'tl_name': 'tn',
+    'course_info': 'ct',
+    'course_name': 'cs',
+    'professor_name': 'pf',
+    'sender_id': 's',
+}
+# 値をそのまま送るキー (reaction_counts のキーは絵文字なので置き換えない)
+RAW_VALUE_KEYS = {'reaction_counts'}
+# 日時の種類ごとの (置き換える整形済み文字列のキー, UNIX秒のキー)
+EPOCH_KEYS = {
+    'post': ('created_at', 't'),
+    'comment': ('created_at', 'tc'),
+    'dm': ('timestamp', 'ti'),
+}
+# 入れ子のキーごとの日時の種類
+NESTED_KINDS = {'comment': 'comment', 'comments': 'comment'}
+# イベントごとの最上位の日時の種類 (既定は post)
+EVENT_KINDS = {'receive_dm': 'dm', 'new_comment': 'comment'}
+
+EPOCH = datetime(1970, 1, 1)
+
+_socketio = None
+
+
+def init_wire(sio_instance):
+    global _socketio
+    _socketio = sio_instance
+
+
+def epoch_seconds(value):
+    """UTC の naive datetime を UNIX 秒 (整数) に変換する"""
+    return int((value - EPOCH).total_seconds())
+
+
+def compact_enabled():
+    return REALTIME_COMPACT_ENCODING and msgpack is not None
+
+
+def accepts_compact(auth):
+    """接続時の auth で compact 形式が要求され、かつ利用可能か"""
+    return compact_enabled() and isinstance(auth, dict) and auth.get('codec') == COMPACT_CODEC
+
+
+def _compact(value, kind):
+    if isinstance(value, dict):
+        date_key, epoch_key = EPOCH_KEYS[kind]
+        has_epoch = 'created_ts' in value
+        result = {}
+        for key, item in value.items():
+            if key == 'created_ts':
+                result[epoch_key] = item
+            elif has_epoch and key == date_key:
+                continue
+            elif key in RAW_VALUE_KEYS:
+                result[SHORT_KEYS.get(key, key)] = item
+            else:
+                result[SHORT_KEYS.get(key, key)] = _compact(item, NESTED_KINDS.get(key, kind))
+        return result
+    if isinstance(value, list):
+        return [_compact(item, kind) for item in value]
+    return value
+
+
+def encode_compact(event, payload):
+    """payload を compact 形式 (MessagePack) に変換する"""
+    return msgpack.packb(_compact(payload, EVENT_KINDS.get(event, 'post')), use_bin_type=True)
+
+
+def emit(event, payload, room):
+    """
+    room の JSON クライアントと compact クライアントにそれぞれの形式で送る。
+    payload は dict または dict を返す関数 (誰も聞いていない場合は呼ばない)。送信したかどうかを返す
+    """
+    targets = presence.listening_rooms(room)
+    if not targets:
+        return False
+    data = payload() if callable(payload) else payload
+    encoded = None
+    for target_room, compact in targets:
+        if compact:
+            if encoded is None:
+                encoded = encode_compact(event, data)
+            _socketio.emit(event, encoded, room=target_room, namespace='/')
+        else:
+            _socketio.emit(event, data, room=target_room, namespace='/')
+    return True